@@ -1,81 +1,750 @@
 import os
+import errno
 import shutil
 import argparse
 import subprocess
-import traceback
+import functools
+import multiprocessing
+import multiprocessing.util
+import logging
+import logging.handlers
+import sys
+import tempfile
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from ffmpeg import FFmpeg
-from pymediainfo import MediaInfo
 import time  # Add this import at the top of the file
-from webptools import dwebp, cwebp  # Import webptools for WebP conversion
-import fitz  # PyMuPDF for PDF processing
 import io
-from PIL import Image
+import json
+import sqlite3
+import re
+import operator
+import heapq
+import contextlib
+from PIL import Image, features
 import pikepdf
-import numpy as np
+
+try:
+    import pyvips  # Optional, faster image decoding with shrink-on-load
+except (ImportError, OSError):
+    pyvips = None
+
+try:
+    import pillow_avif  # Optional, adds AVIF support to Pillow versions without it
+except ImportError:
+    pillow_avif = None
+
+try:
+    import liburing  # Optional, batches small file copies through io_uring on Linux
+except ImportError:
+    liburing = None
+
+try:
+    import av  # Optional, encodes videos in-process instead of running ffmpeg per file
+except ImportError:
+    av = None
 
 # Manually define input and output directories
 INPUT_DIR = "/Users/holzr/roms"
 OUTPUT_DIR = "/Users/holzr/esde_media"
 
+# Hardware HEVC encoders in order of preference, libx265 is used if none work
+HEVC_HW_ENCODERS = ("hevc_videotoolbox", "hevc_nvenc", "hevc_vaapi", "hevc_amf")
+VAAPI_DEVICE = "/dev/dri/renderD128"
+
+# Threads given to each video encode or PDF, the CPU pool runs cpu_count // VIDEO_THREADS at once
+VIDEO_THREADS = 8
+
+# x265 threading tuned to the threads of one encode so parallel encodes don't oversubscribe
+X265_PARAMS = (
+    f"profile=main10:pools={VIDEO_THREADS}"
+    f":frame-threads={min(8, max(1, VIDEO_THREADS // 4))}"
+    ":wpp=1:pmode=1:pme=1:aq-mode=3"
+    ":log-level=error"  # x265 writes its banner and stats straight to stderr
+)
+
+# Encoders used through PyAV when it is installed, the rest need FFmpeg command line options
+PYAV_VIDEO_ENCODERS = ("libx265", "libsvtav1", "hevc_nvenc", "hevc_amf")
+
+# FFmpeg command line options that are named differently on a libav codec context
+_PYAV_OPTION_NAMES = {"b:v": "b", "b:a": "b", "profile:v": "profile"}
+
+# Videos in these formats below this bitrate (bit/s per pixel) are remuxed instead of transcoded
+EFFICIENT_VIDEO_CODECS = ("hevc", "av1")
+EFFICIENT_VIDEO_MAX_BITRATE_PER_PIXEL = 1.5
+
+# Expected output of the video encoders in bits per pixel per frame, used to skip
+# encodes that are projected to end up larger than the source
+ENCODED_BITS_PER_PIXEL = 0.08
+
+# Job kind for each lowercase file extension, files with other extensions are copied
+_EXTENSION_KINDS = {
+    ".mp4": "video",
+    ".pdf": "pdf",
+    ".png": "image",
+    ".jpg": "image",
+    ".jpeg": "image",
+}
+
+# Job kind names used in the skip messages
+_KIND_LABELS = {"video": "video", "pdf": "PDF", "image": "image", "copy": "file"}
+
+# JPEGs below this size (bytes per pixel) are copied instead of converted to WebP
+EFFICIENT_JPEG_MAX_BYTES_PER_PIXEL = 0.5
+
+# WebP encoders, Pillow is used if it was built with libwebp, otherwise cwebp
+_PILLOW_HAS_WEBP = features.check("webp")
+_CWEBP_PATH = shutil.which("cwebp")
+
+# AVIF encoding with Pillow, natively since Pillow 11.2 or through pillow-avif-plugin
+_PILLOW_HAS_AVIF = features.check("avif") or pillow_avif is not None
+
+# mkvmerge (MKVToolNix) is used for remuxing when installed, otherwise FFmpeg
+_MKVMERGE_PATH = shutil.which("mkvmerge")
+
+# Minimum number of seconds between two progress updates of a video encode
+PROGRESS_INTERVAL = 0.2
+
+# Matches the HH:MM:SS.ms time FFmpeg reports in its progress output
+_TIME_RE = re.compile(r"(\d+):(\d+):([\d.]+)")
+
+# Largest number of images encoded by a worker before their sizes are compared together
+IMAGE_BATCH_SIZE = 64
+
+# Number of plain file copies running at once, copies mostly wait on storage
+COPY_THREADS = 32
+
+# Number of plain files collected during the walk before they are copied together
+COPY_BATCH_SIZE = 1024
+
+# With --io_uring, files up to this size are copied by linked io_uring reads and writes
+URING_MAX_FILE_SIZE = 1024 * 1024
+
+# Number of files submitted to io_uring at once, each needs a read and a write entry
+URING_BATCH_SIZE = 32
+
+# Bytes copied by one sendfile call, larger chunks mean fewer calls per file
+SENDFILE_CHUNK_SIZE = 2 * 1024 * 1024
+
+# Buffer size used when a copy has to go through user space
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# copy_file_range and sendfile errors that mean the kernel can't copy these files,
+# not a failed copy
+_COPY_FILE_RANGE_UNSUPPORTED = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+)
+
+# Manifest of processed source files, stored in the output directory
+MANIFEST_NAME = ".optimiser_manifest.sqlite"
+
+# Seconds between two commits of the manifest, an interrupted run loses at most this much
+MANIFEST_COMMIT_INTERVAL = 5
+
+# ocrmypdf module, imported on first use by load_ocrmypdf()
+_ocrmypdf = None
+_ocrmypdf_loaded = False
+
+# Directories this process already created or found, see ensure_dir()
+_ensured_dirs = set()
+
+# Scratch directory of this process, created on first use by get_work_dir()
+_work_dir = None
+
+# Guards the lazily created state above, which threads may ask for at the same
+# time, e.g. on free-threaded Python builds
+_init_lock = threading.Lock()
+
+# Lock shared by pool workers so progress output doesn't interleave
+_print_lock = None
+
+# Logger for all output, per-file messages are INFO and run summaries NOTICE
+log = logging.getLogger("MediaOptimiser")
+
+# Level of the run summaries and chosen settings, still shown with --quiet
+NOTICE = logging.INFO + 5
+logging.addLevelName(NOTICE, "NOTICE")
+
+# Queue the log records of all processes go through, see start_logging()
+_log_queue = None
+
+# Cached result of detect_hevc_encoder()
+_hevc_encoder = None
+
+# time.monotonic() of the last manifest commit, see manifest_mark_done()
+_manifest_commit_time = 0.0
+
+
+def setup_logging(log_queue=None, level=logging.INFO):
+    """
+    Configure the logger of this process.
+
+    Args:
+        log_queue: Queue read by the listener started by start_logging(), records
+            are written straight to stdout without it
+        level: Lowest level that is logged
+    """
+    global _log_queue
+    _log_queue = log_queue
+    if log_queue is not None:
+        handler = logging.handlers.QueueHandler(log_queue)
+    else:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+    log.handlers[:] = [handler]
+    log.setLevel(level)
+    log.propagate = False
+
+
+def start_logging(quiet=False):
+    """
+    Send the log records of this process and its workers through a queue to a
+    listener thread that writes them to stdout. Workers only put records on the
+    queue, so they don't wait for the console or for each other.
+
+    Args:
+        quiet: If True, only log summaries, warnings and errors, not every file
+
+    Returns:
+        QueueListener: Listener to stop at exit, which writes the remaining records
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    log_queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    setup_logging(log_queue, NOTICE if quiet else logging.INFO)
+    return listener
+
+
+# Log straight to stdout until start_logging() is called, e.g. when imported
+setup_logging()
+
+
+def sendfile_rest(source_fd, dest_fd):
+    """
+    Copy the rest of a file from its current position with sendfile, which keeps
+    the data in the kernel.
+
+    Args:
+        source_fd: Descriptor of the source file
+        dest_fd: Descriptor of the destination file, written at its current position
+
+    Returns:
+        bool: True if the copy is done, False if sendfile can't copy these files and
+        the rest still has to be copied, with both positions unchanged
+    """
+    start = offset = os.lseek(source_fd, 0, os.SEEK_CUR)
+    try:
+        while True:
+            sent = os.sendfile(dest_fd, source_fd, offset, SENDFILE_CHUNK_SIZE)
+            if not sent:
+                return True
+            offset += sent
+    except OSError as sendfile_error:
+        # Only give up if nothing was sent, else the copy really failed
+        if sendfile_error.errno not in _COPY_FILE_RANGE_UNSUPPORTED or offset != start:
+            raise
+        return False
 
-def optimize_video(source_file, dest_file, use_av1=False):
+
+def fast_copy(source_file, dest_file, dest_fd=None):
     """
-    Convert MP4 video to MKV using x265 or AV1 encoding with optimized parameters.
+    Copy a file and its metadata, letting the kernel copy the data where possible.
+    Uses copy_file_range on Linux (a reflink on filesystems that support it), then
+    sendfile for copies between filesystems it can't handle, and shutil.copyfile
+    elsewhere, which already uses fcopyfile on macOS.
+
+    Args:
+        source_file: Path to the file to copy
+        dest_file: Path to the copy
+        dest_fd: Optional descriptor of dest_file opened for writing, see reserve_dest.
+            It is closed when the copy is done.
+    """
+    if hasattr(os, "copy_file_range"):
+        dest = dest_file if dest_fd is None else dest_fd
+        try:
+            fsrc = open(source_file, "rb")
+        except OSError:
+            # Don't leak the caller's descriptor, the caller removes the reserved file
+            if dest_fd is not None:
+                os.close(dest_fd)
+            raise
+        with fsrc, open(dest, "wb") as fdst:
+            try:
+                # copy_file_range may copy less than asked, keep going until EOF
+                while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                    pass
+            except OSError as copy_error:
+                # Not supported between these files, try sendfile for the rest
+                if copy_error.errno not in _COPY_FILE_RANGE_UNSUPPORTED:
+                    raise
+                if not sendfile_rest(fsrc.fileno(), fdst.fileno()):
+                    # Neither works, copy the rest through user space
+                    shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+    else:
+        if dest_fd is not None:
+            os.close(dest_fd)
+        shutil.copyfile(source_file, dest_file)
+    shutil.copystat(source_file, dest_file)
+
+
+def source_stat(source_file, source_entry=None):
+    """
+    Stat a source file, using the cached result of its DirEntry from the walk if
+    there is one, so the source is stat'ed at most once however often it's asked.
+
+    Args:
+        source_file: Path to the source file
+        source_entry: Optional os.DirEntry of source_file
+
+    Returns:
+        os.stat_result: Stat result of source_file
+    """
+    if source_entry is not None:
+        return source_entry.stat()
+    return os.stat(source_file)
+
+
+def reserve_dest(dest_file, source_file=None, source_entry=None):
+    """
+    Create dest_file for writing unless a finished copy is already there. This
+    replaces the stat before every plain copy with the open the copy needs anyway.
+
+    Args:
+        dest_file: Path to the destination file
+        source_file: Optional path to the source file, an existing copy then only
+            counts as finished if it has the same size
+        source_entry: Optional os.DirEntry of source_file, see source_stat
+
+    Returns:
+        int or None: Descriptor opened for writing, None if dest_file already exists
+    """
+    try:
+        return os.open(dest_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        dest_size = os.stat(dest_file).st_size
+        if dest_size > 0 and (
+            source_file is None
+            or dest_size == source_stat(source_file, source_entry).st_size
+        ):
+            return None
+        # Empty or cut off leftovers of an interrupted copy are overwritten
+        return os.open(dest_file, os.O_WRONLY | os.O_TRUNC)
+
+
+def hevc_input_options(encoder):
+    """
+    Get the FFmpeg options that have to be placed before the input file for an HEVC encoder.
+    """
+    if encoder == "hevc_vaapi":
+        return {
+            "vaapi_device": VAAPI_DEVICE,
+            "hwaccel": "vaapi",
+            "hwaccel_output_format": "vaapi",
+        }
+    return {}
+
+
+def hevc_encoder_options(encoder):
+    """
+    Get the FFmpeg video encoding options for an HEVC encoder.
+    """
+    if encoder == "hevc_videotoolbox":
+        return {
+            "c:v": "hevc_videotoolbox",
+            "q:v": "65",
+            "profile:v": "main10",
+            "pix_fmt": "p010le",
+        }
+    if encoder == "hevc_nvenc":
+        return {
+            "c:v": "hevc_nvenc",
+            "preset": "p6",
+            "rc": "vbr",
+            "cq": "23",
+            "b:v": "0",
+            "profile:v": "main10",
+            "pix_fmt": "p010le",
+        }
+    if encoder == "hevc_vaapi":
+        return {
+            "vf": "format=nv12|vaapi,hwupload",
+            "c:v": "hevc_vaapi",
+            "rc_mode": "CQP",
+            "qp": "23",
+        }
+    if encoder == "hevc_amf":
+        return {
+            "c:v": "hevc_amf",
+            "quality": "quality",
+            "rc": "cqp",
+            "qp_i": "22",
+            "qp_p": "24",
+        }
+    # x265 encoding options (original)
+    return {
+        "c:v": "libx265",
+        "preset": "slow",
+        "crf": "23",
+        "x265-params": X265_PARAMS,
+        "pix_fmt": "yuv420p10le",
+    }
+
+
+def detect_hevc_encoder():
+    """
+    Find the first hardware HEVC encoder that FFmpeg can actually use.
+    The result is cached so FFmpeg is only probed once per process.
+
+    Returns:
+        str: Name of the encoder to use, "libx265" if no hardware encoder works
+    """
+    global _hevc_encoder
+    if _hevc_encoder is not None:
+        return _hevc_encoder
+
+    # Only published when probing is done, so other threads never see a partial result
+    chosen = "libx265"
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", "-encoders"], capture_output=True, text=True
+        )
+        available = set()
+        for line in result.stdout.splitlines():
+            parts = line.split()
+            if len(parts) > 1:
+                available.add(parts[1])
+
+        for encoder in HEVC_HW_ENCODERS:
+            if encoder not in available:
+                continue
+
+            # Being compiled into FFmpeg doesn't mean the hardware is present,
+            # so encode a single test frame before trusting the encoder
+            command = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+            for key, value in hevc_input_options(encoder).items():
+                command += [f"-{key}", value]
+            command += [
+                "-f",
+                "lavfi",
+                "-i",
+                "color=c=black:s=256x256",
+                "-frames:v",
+                "1",
+            ]
+            for key, value in hevc_encoder_options(encoder).items():
+                command += [f"-{key}", value]
+            command += ["-f", "null", "-"]
+
+            test_result = subprocess.run(command, capture_output=True, text=True)
+            if test_result.returncode == 0:
+                chosen = encoder
+                break
+            log.warning(f"Hardware encoder {encoder} is not usable, trying next option")
+    except (FileNotFoundError, subprocess.SubprocessError) as probe_error:
+        log.warning(f"Could not probe FFmpeg encoders: {probe_error}")
+
+    _hevc_encoder = chosen
+    log.log(NOTICE, f"Using HEVC encoder: {_hevc_encoder}")
+    return _hevc_encoder
+
+
+def make_progress_time_getter(progress):
+    """
+    Pick a function that reads the current encode position in seconds from progress
+    events shaped like this one, so the type checks only run once per encode.
+
+    Args:
+        progress: A sample progress event, either an object or a dict with a "time"
+
+    Returns:
+        callable: Function taking a progress event and returning seconds as a float
+    """
+    if isinstance(progress, dict):
+        if "time" not in progress:
+            return lambda p: 0
+        get_time = operator.itemgetter("time")
+    elif hasattr(progress, "time"):
+        get_time = operator.attrgetter("time")
+    else:
+        return lambda p: 0
+
+    # Handle timedelta objects directly
+    if hasattr(get_time(progress), "total_seconds"):
+        return lambda p: get_time(p).total_seconds()
+
+    # Otherwise parse the time string
+    def parse_time(p):
+        match = _TIME_RE.match(str(get_time(p)))
+        if match is None:
+            return 0
+        return int(match[1]) * 3600 + int(match[2]) * 60 + float(match[3])
+
+    return parse_time
+
+
+def pyav_codec_options(options):
+    """
+    Turn FFmpeg command line encoder options into libav codec context options.
+
+    Args:
+        options: Dict of FFmpeg options including the "c:v"/"c:a" codec and "pix_fmt"
+
+    Returns:
+        dict: Codec context options for PyAV
+    """
+    return {
+        _PYAV_OPTION_NAMES.get(key, key): value
+        for key, value in options.items()
+        if key not in ("c:v", "c:a", "pix_fmt")
+    }
+
+
+def transcode_with_pyav(
+    source_file, dest_file, video_options, audio_options, on_position=None
+):
+    """
+    Transcode a video into an MKV file inside this process using PyAV.
+
+    Args:
+        source_file: Path to the source video file
+        dest_file: Path to the destination MKV file
+        video_options: FFmpeg video encoder options, see hevc_encoder_options
+        audio_options: FFmpeg audio encoder options
+        on_position: Optional callable given the encoded position in seconds
+    """
+    with av.open(source_file) as input_container, av.open(
+        dest_file, "w", format="matroska"
+    ) as output_container:
+        # First video stream that isn't cover art, like the ffprobe selection
+        in_video = next(
+            stream
+            for stream in input_container.streams.video
+            if not stream.disposition & av.stream.Disposition.attached_pic
+        )
+        in_video.thread_type = "AUTO"
+
+        # Video stream with the same size and frame rate as the source
+        out_video = output_container.add_stream(
+            video_options["c:v"],
+            rate=in_video.average_rate or in_video.guessed_rate,
+            options=pyav_codec_options(video_options),
+        )
+        out_video.width = in_video.codec_context.width
+        out_video.height = in_video.codec_context.height
+        out_video.pix_fmt = video_options.get("pix_fmt", "yuv420p")
+        out_video.codec_context.thread_count = VIDEO_THREADS
+
+        streams = {in_video: out_video}
+
+        # Audio stream, PyAV resamples the decoded frames to what the encoder wants
+        if input_container.streams.audio:
+            in_audio = input_container.streams.audio[0]
+            out_audio = output_container.add_stream(
+                audio_options["c:a"],
+                rate=48000,  # Opus only supports a few sample rates
+                options=pyav_codec_options(audio_options),
+            )
+            out_audio.layout = "mono" if in_audio.channels == 1 else "stereo"
+            streams[in_audio] = out_audio
+
+        for packet in input_container.demux(*streams):
+            out_stream = streams[packet.stream]
+            for frame in packet.decode():
+                output_container.mux(out_stream.encode(frame))
+                if (
+                    on_position is not None
+                    and packet.stream is in_video
+                    and frame.time is not None
+                ):
+                    on_position(frame.time)
+
+        # Flush frames still buffered in the encoders
+        for out_stream in streams.values():
+            output_container.mux(out_stream.encode(None))
+
+
+def remux_to_mkv(source_file, dest_file):
+    """
+    Remux a video into an MKV container without transcoding.
+    Falls back to a direct copy if remuxing fails.
+
+    Args:
+        source_file: Path to the source video file
+        dest_file: Path to the destination MKV file
+    """
+    input_size = os.path.getsize(source_file)
+
+    # Remux to a temporary file that only replaces dest_file once it's complete
+    part_file = dest_file + ".part.mkv"
+
+    try:
+        remuxed = False
+        if _MKVMERGE_PATH is not None:
+            # mkvmerge is a dedicated Matroska muxer, exit code 1 only means warnings
+            result = subprocess.run(
+                [_MKVMERGE_PATH, "-q", "-o", part_file, source_file],
+                capture_output=True,
+                text=True,
+            )
+            remuxed = result.returncode in (0, 1)
+            if not remuxed:
+                log.warning(
+                    f"mkvmerge failed: {result.stdout.strip()}, remuxing with FFmpeg"
+                )
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+
+        if not remuxed:
+            # Create a new FFmpeg instance for remuxing
+            remux_ffmpeg = FFmpeg()
+            remux_ffmpeg.option("y")  # Overwrite leftovers without asking
+            remux_ffmpeg.option("i", source_file)
+            remux_ffmpeg.option("c", "copy")  # Copy all streams without transcoding
+            remux_ffmpeg.output(part_file)
+
+            # Only a normal exit counts, a terminated FFmpeg returns without raising
+            @remux_ffmpeg.on("completed")
+            def on_completed():
+                nonlocal remuxed
+                remuxed = True
+
+            # Execute the remux command
+            remux_ffmpeg.execute()
+
+        if remuxed and os.path.exists(part_file) and os.path.getsize(part_file) > 0:
+            os.replace(part_file, dest_file)
+            remux_size = os.path.getsize(dest_file)
+            log.info(
+                f"Remuxed: {source_file} ({input_size/1024/1024:.2f}MB) -> {dest_file} ({remux_size/1024/1024:.2f}MB)"
+            )
+            return
+        log.warning("Remuxing failed, falling back to direct copy")
+    except Exception as remux_error:
+        log.warning(
+            f"Error during remuxing: {remux_error}, falling back to direct copy"
+        )
+
+    # Don't leave a partial remux behind, the copy goes through the part file too
+    if os.path.exists(part_file):
+        os.remove(part_file)
+    fast_copy(source_file, part_file)
+    os.replace(part_file, dest_file)
+    log.info(f"Copied: {source_file} ({input_size/1024/1024:.2f}MB) -> {dest_file}")
+
+
+def optimize_video(source_file, dest_file, use_av1=False, use_hw_encoder=True):
+    """
+    Convert MP4 video to MKV using HEVC or AV1 encoding with optimized parameters.
+    HEVC uses a hardware encoder when one is available, otherwise x265.
 
     Args:
         source_file: Path to the source MP4 file
         dest_file: Path to the destination MKV file
-        use_av1: If True, use AV1 encoding instead of x265
+        use_av1: If True, use AV1 encoding instead of HEVC
+        use_hw_encoder: If False, always use x265 for HEVC encoding
 
     Returns:
         bool: True if successful, False otherwise
     """
     try:
-        # Check if destination file already exists - skip if it does
-        if os.path.exists(dest_file) and os.path.getsize(dest_file) > 0:
-            print(f"Skipping existing file: {dest_file}")
-            return True
-
         # Validate input file first
         if not os.path.exists(source_file) or os.path.getsize(source_file) == 0:
-            print(f"Invalid input file (missing or empty): {source_file}")
+            log.error(f"Invalid input file (missing or empty): {source_file}")
             return False
 
         # Skip hidden files (starting with ._)
         if os.path.basename(source_file).startswith("._"):
-            print(f"Skipping hidden file: {source_file}")
+            log.info(f"Skipping hidden file: {source_file}")
             return False
 
-        # Get media information using pymediainfo
-        media_info = MediaInfo.parse(source_file)
+        # Get stream information with a single ffprobe call
+        probe_result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_streams",
+                "-show_format",
+                "-of",
+                "json",
+                source_file,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        probe = json.loads(probe_result.stdout)
+        format_info = probe.get("format", {})
 
-        # Get total duration in seconds for progress calculation
-        duration_seconds = 0
-        for track in media_info.tracks:
-            if track.track_type == "Video":
-                if hasattr(track, "duration") and track.duration:
-                    duration_seconds = (
-                        float(track.duration) / 1000.0
-                    )  # Convert ms to seconds
-                break
+        # Find the video stream (ignoring cover art) and the audio codec in one pass
+        video_stream = None
+        audio_codec = ""
+        for stream in probe.get("streams", []):
+            codec_type = stream.get("codec_type")
+            if codec_type == "video" and video_stream is None:
+                if not stream.get("disposition", {}).get("attached_pic"):
+                    video_stream = stream
+            elif codec_type == "audio" and not audio_codec:
+                audio_codec = stream.get("codec_name", "")
 
         # Verify the file actually contains video streams
-        has_video = False
-        for track in media_info.tracks:
-            if track.track_type == "Video":
-                has_video = True
-                break
-
-        if not has_video:
-            print(f"No video stream found in file: {source_file}")
+        if video_stream is None:
+            log.warning(f"No video stream found in file: {source_file}")
             return False
 
-        # Find the audio track and get its codec
-        audio_codec = ""
-        for track in media_info.tracks:
-            if track.track_type == "Audio":
-                audio_codec = track.codec.lower() if track.codec else ""
-                break
+        # Get total duration in seconds for progress calculation
+        duration_seconds = float(
+            video_stream.get("duration") or format_info.get("duration") or 0
+        )
+
+        # Videos already in an efficient codec at a low bitrate won't shrink when
+        # transcoded again, so skip the encoder and just remux them
+        video_codec = video_stream.get("codec_name", "")
+        bit_rate = float(
+            video_stream.get("bit_rate") or format_info.get("bit_rate") or 0
+        )
+        width = video_stream.get("width") or 0
+        height = video_stream.get("height") or 0
+        if (
+            video_codec in EFFICIENT_VIDEO_CODECS
+            and bit_rate
+            and width
+            and height
+            and bit_rate / (width * height) < EFFICIENT_VIDEO_MAX_BITRATE_PER_PIXEL
+        ):
+            log.info(
+                f"Video is already efficiently encoded ({video_codec}), remuxing to MKV without transcoding..."
+            )
+            remux_to_mkv(source_file, dest_file)
+            return os.path.exists(dest_file) and os.path.getsize(dest_file) > 0
+
+        # Estimate the size of the encode, if it can't beat the source don't write it at all
+        frame_rate = video_stream.get("avg_frame_rate") or "0/1"
+        rate_num, _, rate_den = frame_rate.partition("/")
+        fps = float(rate_num) / float(rate_den) if rate_den and float(rate_den) else 0
+        projected_size = (
+            ENCODED_BITS_PER_PIXEL * width * height * fps * duration_seconds / 8
+        )
+        if projected_size > os.path.getsize(source_file):
+            log.info(
+                "Encoding is not expected to make the file smaller, remuxing to MKV without transcoding..."
+            )
+            remux_to_mkv(source_file, dest_file)
+            return os.path.exists(dest_file) and os.path.getsize(dest_file) > 0
+
+        # Encode to a temporary file that only replaces dest_file once it's complete and smaller
+        part_file = dest_file + ".part.mkv"
+
+        # A part file left behind by an interrupted run is never finished, drop it
+        if os.path.exists(part_file):
+            os.remove(part_file)
 
         # Determine audio encoding options - always convert to Opus VBR 96kbps
         audio_options = {
@@ -85,426 +754,594 @@ def optimize_video(source_file, dest_file, use_av1=False):
             "compression_level": "10",
         }
 
-        # Configure FFmpeg for video conversion - corrected initialization
-        ffmpeg = FFmpeg()
-
-        # Add input file
-        ffmpeg.option("i", source_file)
+        # Pick the HEVC encoder (hardware if available)
+        encoder = "libx265"
+        if not use_av1 and use_hw_encoder:
+            encoder = detect_hevc_encoder()
 
-        # Add video encoding options based on codec choice
+        # Video encoding options based on codec choice
         if use_av1:
             # SVT-AV1 encoding options
-            ffmpeg.option("c:v", "libsvtav1")
-            ffmpeg.option("crf", "40")  # Higher CRF for AV1 as it's more efficient
-            ffmpeg.option(
-                "preset", "6"
-            )  # SVT-AV1 preset (0-13, lower = slower/better quality)
-            ffmpeg.option("svtav1-params", "tune=0:enable-overlays=1:scd=1")
-            ffmpeg.option("pix_fmt", "yuv420p10le")
+            video_options = {
+                "c:v": "libsvtav1",
+                "crf": "40",  # Higher CRF for AV1 as it's more efficient
+                "preset": "6",  # SVT-AV1 preset (0-13, lower = slower/better quality)
+                "svtav1-params": "tune=0:enable-overlays=1:scd=1",
+                "pix_fmt": "yuv420p10le",
+            }
         else:
-            # x265 encoding options (original)
-            ffmpeg.option("c:v", "libx265")
-            ffmpeg.option("preset", "slow")
-            ffmpeg.option("crf", "23")
-            ffmpeg.option("x265-params", "profile=main10")
-            ffmpeg.option("pix_fmt", "yuv420p10le")
-
-        # Add audio encoding options
-        for key, value in audio_options.items():
-            ffmpeg.option(key, value)
-
-        # Set output file
-        ffmpeg.output(dest_file)
+            # HEVC encoding options for the selected encoder
+            video_options = hevc_encoder_options(encoder)
 
         # Store the start time for ETA calculation
         start_time = time.time()
 
-        # Add progress handler to show encoding progress
-        @ffmpeg.on("progress")
-        def on_progress(progress):
-            try:
-                # Calculate percentage based on current time and total duration
-                current_time_str = None
-                current_time_seconds = 0
-
-                # Extract current time from progress object
-                if hasattr(progress, "time"):
-                    # Handle timedelta objects directly
-                    if hasattr(progress.time, "total_seconds"):
-                        current_time_seconds = progress.time.total_seconds()
-                    else:
-                        current_time_str = str(progress.time)
-                elif isinstance(progress, dict) and "time" in progress:
-                    # Handle timedelta objects directly
-                    if hasattr(progress["time"], "total_seconds"):
-                        current_time_seconds = progress["time"].total_seconds()
+        # Codec name shown in the progress output
+        if use_av1:
+            codec_name = "SVT-AV1"
+        elif encoder == "libx265":
+            codec_name = "x265"
+        else:
+            codec_name = encoder
+
+        # Progress state, the time extractor is picked from the first progress event
+        last_progress_print = 0.0
+        get_progress_seconds = None
+
+        def show_progress(current_time_seconds):
+            nonlocal last_progress_print
+
+            # Encoders report progress many times per second, only redraw now and then
+            now = time.monotonic()
+            if now - last_progress_print < PROGRESS_INTERVAL:
+                return
+            last_progress_print = now
+
+            # Calculate percentage
+            percentage = 0
+            eta_str = "unknown"
+
+            if duration_seconds > 0 and current_time_seconds > 0:
+                percentage = min(100, (current_time_seconds / duration_seconds) * 100)
+
+                # Calculate ETA (estimated time remaining)
+                if percentage > 0:
+                    elapsed_time = time.time() - start_time
+                    total_estimated_time = elapsed_time * 100 / percentage
+                    time_remaining = total_estimated_time - elapsed_time
+
+                    # Format the time remaining
+                    if time_remaining < 60:
+                        eta_str = f"{time_remaining:.0f} seconds"
+                    elif time_remaining < 3600:
+                        eta_str = f"{time_remaining/60:.1f} minutes"
                     else:
-                        current_time_str = str(progress["time"])
+                        eta_str = f"{time_remaining/3600:.1f} hours"
 
-                # If we have a string, parse it as time
-                if current_time_str and current_time_seconds == 0:
-                    try:
-                        time_parts = current_time_str.split(":")
-                        if len(time_parts) >= 3:
-                            hours = int(time_parts[0])
-                            minutes = int(time_parts[1])
-                            seconds = float(time_parts[2])
-                            current_time_seconds = hours * 3600 + minutes * 60 + seconds
-                    except (ValueError, IndexError, AttributeError):
-                        pass
-
-                # Calculate percentage
-                percentage = 0
-                eta_str = "unknown"
-
-                if duration_seconds > 0 and current_time_seconds > 0:
-                    percentage = min(
-                        100, (current_time_seconds / duration_seconds) * 100
-                    )
+            # Display progress with ETA and codec info
+            print_progress(
+                f"Encoding ({codec_name}): {os.path.basename(source_file)} - {percentage:.1f}% - ETA: {eta_str}"
+            )
 
-                    # Calculate ETA (estimated time remaining)
-                    if percentage > 0:
-                        elapsed_time = time.time() - start_time
-                        total_estimated_time = elapsed_time * 100 / percentage
-                        time_remaining = total_estimated_time - elapsed_time
-
-                        # Format the time remaining
-                        if time_remaining < 60:
-                            eta_str = f"{time_remaining:.0f} seconds"
-                        elif time_remaining < 3600:
-                            eta_str = f"{time_remaining/60:.1f} minutes"
-                        else:
-                            eta_str = f"{time_remaining/3600:.1f} hours"
-
-                # Display progress with ETA and codec info
-                codec_name = "SVT-AV1" if use_av1 else "x265"
-                print(
-                    f"Encoding ({codec_name}): {os.path.basename(source_file)} - {percentage:.1f}% - ETA: {eta_str}",
-                    end="\r",
+        # Encode in-process with PyAV when possible, saves starting an ffmpeg process per file
+        encoded = False
+        if av is not None and video_options["c:v"] in PYAV_VIDEO_ENCODERS:
+            try:
+                transcode_with_pyav(
+                    source_file, part_file, video_options, audio_options, show_progress
                 )
-            except Exception as progress_error:
-                # Don't let progress display issues interrupt the encoding
-                print(f"\nProgress display error: {progress_error}")
-                print(f"Progress object type: {type(progress)}")
-                if hasattr(progress, "time"):
-                    print(f"Time object type: {type(progress.time)}")
-
-        # Execute the FFmpeg command
-        ffmpeg.execute()
-
-        # Check if the destination file was created successfully
-        if os.path.exists(dest_file) and os.path.getsize(dest_file) > 0:
+                encoded = True
+            except Exception as pyav_error:
+                log.warning(
+                    f"PyAV encoding failed for {source_file}, falling back to FFmpeg: {pyav_error}"
+                )
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+
+        if not encoded:
+            # Configure FFmpeg for video conversion - corrected initialization
+            ffmpeg = FFmpeg()
+
+            # Hardware decode/upload options have to come before the input file
+            if not use_av1:
+                for key, value in hevc_input_options(encoder).items():
+                    ffmpeg.option(key, value)
+
+            # Add input file
+            ffmpeg.option("i", source_file)
+
+            # Add video and audio encoding options
+            for key, value in video_options.items():
+                ffmpeg.option(key, value)
+            for key, value in audio_options.items():
+                ffmpeg.option(key, value)
+
+            # Limit encoder threads so parallel encodes don't oversubscribe the CPU
+            ffmpeg.option("threads", str(VIDEO_THREADS))
+
+            # Overwrite without asking, FFmpeg would otherwise wait at its prompt
+            ffmpeg.option("y")
+
+            # Set output file
+            ffmpeg.output(part_file)
+
+            # Add progress handler to show encoding progress
+            @ffmpeg.on("progress")
+            def on_progress(progress):
+                nonlocal get_progress_seconds
+
+                try:
+                    # Extract current time from progress object
+                    if get_progress_seconds is None:
+                        get_progress_seconds = make_progress_time_getter(progress)
+                    show_progress(get_progress_seconds(progress))
+                except Exception as progress_error:
+                    # Don't let progress display issues interrupt the encoding
+                    log.error(f"Progress display error: {progress_error}")
+                    log.error(f"Progress object type: {type(progress)}")
+                    if hasattr(progress, "time"):
+                        log.error(f"Time object type: {type(progress.time)}")
+
+            # Only a normal exit counts, a terminated FFmpeg returns without raising
+            @ffmpeg.on("completed")
+            def on_completed():
+                nonlocal encoded
+                encoded = True
+
+            # Execute the FFmpeg command, it raises if FFmpeg fails
+            ffmpeg.execute()
+
+        # Only a finished encode is compared and promoted to dest_file
+        if encoded and os.path.exists(part_file) and os.path.getsize(part_file) > 0:
             # Compare file sizes and use the smaller one
             input_size = os.path.getsize(source_file)
-            output_size = os.path.getsize(dest_file)
+            output_size = os.path.getsize(part_file)
 
             if input_size < output_size:
                 # If original file is smaller, delete the transcoded file
-                os.remove(dest_file)
+                os.remove(part_file)
 
                 # Remux the original file into MKV container without transcoding
-                print(
-                    f"Original file is smaller, remuxing to MKV without transcoding..."
+                log.info(
+                    "Original file is smaller, remuxing to MKV without transcoding..."
                 )
 
-                # Create a new FFmpeg instance for remuxing
-                remux_ffmpeg = FFmpeg()
-                remux_ffmpeg.option("i", source_file)
-                remux_ffmpeg.option("c", "copy")  # Copy all streams without transcoding
-                remux_ffmpeg.output(dest_file)
-
-                try:
-                    # Execute the remux command
-                    remux_ffmpeg.execute()
-
-                    if os.path.exists(dest_file) and os.path.getsize(dest_file) > 0:
-                        remux_size = os.path.getsize(dest_file)
-                        print(
-                            f"Remuxed: {source_file} ({input_size/1024/1024:.2f}MB) -> {dest_file} ({remux_size/1024/1024:.2f}MB)"
-                        )
-                    else:
-                        print(f"Remuxing failed, falling back to direct copy")
-                        shutil.copy2(source_file, dest_file)
-                        print(
-                            f"Copied: {source_file} ({input_size/1024/1024:.2f}MB) -> {dest_file}"
-                        )
-                except Exception as remux_error:
-                    print(
-                        f"Error during remuxing: {remux_error}, falling back to direct copy"
-                    )
-                    shutil.copy2(source_file, dest_file)
-                    print(
-                        f"Copied: {source_file} ({input_size/1024/1024:.2f}MB) -> {dest_file}"
-                    )
+                remux_to_mkv(source_file, dest_file)
             else:
                 # Transcoded file is smaller or equal size, keep it
-                print(
+                os.replace(part_file, dest_file)
+                log.info(
                     f"Optimized: {source_file} ({input_size/1024/1024:.2f}MB) -> {dest_file} ({output_size/1024/1024:.2f}MB)"
                 )
 
             return True
         else:
-            print(
-                f"Optimization seemed to complete but output file is missing or empty: {dest_file}"
+            log.error(
+                f"Optimization seemed to complete but output file is missing or empty: {part_file}"
             )
             return False
     except Exception as e:
-        print(f"Error optimizing {source_file}: {str(e)}")
+        log.error(f"Error optimizing {source_file}: {str(e)}")
         # If a partial output file was created, remove it
-        if os.path.exists(dest_file):
-            try:
-                os.remove(dest_file)
-                print(f"Removed partial output file: {dest_file}")
-            except Exception as cleanup_error:
-                print(f"Failed to remove partial output file: {cleanup_error}")
+        for partial_file in (dest_file + ".part.mkv", dest_file):
+            if os.path.exists(partial_file):
+                try:
+                    os.remove(partial_file)
+                    log.info(f"Removed partial output file: {partial_file}")
+                except Exception as cleanup_error:
+                    log.error(f"Failed to remove partial output file: {cleanup_error}")
         return False
 
 
-def optimize_image(source_file, dest_file):
+def cwebp_encode(source_file, resize=None):
     """
-    Convert PNG or JPG/JPEG to WebP format while keeping original extension.
+    Encode an image to WebP with the cwebp tool, used when Pillow has no WebP support.
+    The image is streamed through stdin/stdout so no temporary files are needed.
 
     Args:
         source_file: Path to the source image file
-        dest_file: Path to the destination file (should have original extension)
+        resize: Optional (width, height) to scale to, 0 keeps the aspect ratio
 
     Returns:
-        bool: True if successful, False otherwise
+        bytes: The encoded WebP image, or None if cwebp is missing or failed
+    """
+    if not _CWEBP_PATH:
+        log.warning("Pillow has no WebP support and cwebp was not found in PATH")
+        return None
+
+    command = [_CWEBP_PATH, "-quiet", "-q", "80"]
+    if resize:
+        command += ["-resize", str(resize[0]), str(resize[1])]
+    command += ["-o", "-", "--", "-"]
+
+    with open(source_file, "rb") as f:
+        result = subprocess.run(
+            command,
+            stdin=f,
+            capture_output=True,
+        )
+    if result.returncode != 0:
+        log.error(f"cwebp conversion failed: {result.stderr.decode(errors='replace')}")
+        return None
+    return result.stdout
+
+
+def sniff_image_type(path):
+    """
+    Detect an image type from the magic bytes at the start of the file.
+
+    Returns:
+        str: "png", "jpg", "webp" or "gif", or None if the type isn't recognised
+    """
+    with open(path, "rb") as f:
+        header = f.read(16)
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    if header[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    return None
+
+
+def vips_encode(source_file, max_dimension=None, avif=False):
+    """
+    Encode an image to WebP with libvips. Images are streamed instead of loaded
+    into memory, and JPEGs are decoded at reduced size when downscaling.
+
+    Args:
+        source_file: Path to the source image file
+        max_dimension: Optional maximum width/height of the output
+        avif: If True, encode to AVIF instead of WebP
+
+    Returns:
+        bytes: The encoded image
+    """
+    if max_dimension:
+        # thumbnail() picks the JPEG shrink-on-load factor itself
+        image = pyvips.Image.thumbnail(
+            source_file, max_dimension, height=max_dimension, size="down"
+        )
+    else:
+        image = pyvips.Image.new_from_file(source_file, access="sequential")
+    if avif:
+        return image.heifsave_buffer(Q=60, compression="av1", effort=4)
+    return image.webpsave_buffer(Q=80, effort=4)
+
+
+def avif_encode(source_file, max_dimension=None):
+    """
+    Encode an image to AVIF in memory with libvips or Pillow.
+
+    Args:
+        source_file: Path to the source image file
+        max_dimension: Optional maximum width/height of the output
+
+    Returns:
+        bytes: The encoded AVIF image, or None if no AVIF encoder is available
     """
     try:
-        # Check if destination file already exists - skip if it does
-        if os.path.exists(dest_file) and os.path.getsize(dest_file) > 0:
-            print(f"Skipping existing file: {dest_file}")
-            return True
+        if pyvips is not None:
+            return vips_encode(source_file, max_dimension, avif=True)
+        if _PILLOW_HAS_AVIF:
+            with Image.open(source_file) as img:
+                if max_dimension:
+                    img.thumbnail((max_dimension, max_dimension))
+                avif_buffer = io.BytesIO()
+                # speed 6 balances encode time against file size
+                img.save(avif_buffer, "AVIF", quality=60, speed=6)
+                return avif_buffer.getbuffer()
+    except Exception as avif_error:
+        log.error(f"AVIF conversion error: {str(avif_error)}")
+    return None
+
+
+def encode_image(source_file, dest_file, max_dimension=None, use_avif=False):
+    """
+    Encode an image to WebP in memory. Images that don't need converting are
+    copied to dest_file right away.
+
+    Args:
+        source_file: Path to the source image file
+        dest_file: Path to the destination file (should have original extension)
+        max_dimension: If set, downscale images so neither side exceeds this many pixels
+        use_avif: If True, also encode to AVIF and keep the smaller of WebP and AVIF
 
+    Returns:
+        bool or tuple: True/False if the image is already handled, otherwise
+        (input_size, encoded_data) to be passed to write_image
+    """
+    try:
         # Validate input file first
         if not os.path.exists(source_file) or os.path.getsize(source_file) == 0:
-            print(f"Invalid input file (missing or empty): {source_file}")
+            log.error(f"Invalid input file (missing or empty): {source_file}")
             return False
 
         # Skip hidden files
         if os.path.basename(source_file).startswith("._"):
-            print(f"Skipping hidden file: {source_file}")
+            log.info(f"Skipping hidden file: {source_file}")
             return False
 
-        # Get file extension
-        _, ext = os.path.splitext(source_file)
-        ext = ext.lower()
+        # Detect the real image type, scraped files often have the wrong extension
+        image_type = sniff_image_type(source_file)
 
         # Convert to WebP
-        if ext in [".png", ".jpg", ".jpeg"]:
-            # Check if the filename has spaces or special characters
-            has_special_chars = (
-                " " in source_file or "(" in source_file or ")" in source_file
-            )
+        if image_type in ("png", "jpg", "webp"):
+            input_size = os.path.getsize(source_file)
+
+            # Encode straight into memory with libvips or Pillow - no temporary files
+            webp_data = None
+            needs_resize = False
+            try:
+                with Image.open(source_file) as img:
+                    needs_resize = bool(max_dimension) and max(img.size) > max_dimension
+
+                    # Already WebP or an efficiently compressed JPEG - re-encoding won't pay off
+                    if not needs_resize and (
+                        img.format == "WEBP"
+                        or (
+                            img.format == "JPEG"
+                            and input_size / (img.width * img.height)
+                            < EFFICIENT_JPEG_MAX_BYTES_PER_PIXEL
+                        )
+                    ):
+                        fast_copy(source_file, dest_file)
+                        log.info(
+                            f"Already efficiently compressed ({img.format}), copied: {source_file} -> {dest_file}"
+                        )
+                        return True
+
+                    log.info(f"Converting {source_file} to WebP...")
+                    resize = None
+                    if needs_resize:
+                        resize = (
+                            (max_dimension, 0)
+                            if img.width >= img.height
+                            else (0, max_dimension)
+                        )
 
-            # Create a temporary directory for processing
-            temp_dir = os.path.join(os.path.dirname(dest_file), ".tmp_webp_conversion")
-            os.makedirs(temp_dir, exist_ok=True)
+                    if pyvips is None and _PILLOW_HAS_WEBP:
+                        if needs_resize:
+                            # thumbnail() uses draft mode so JPEGs are decoded at reduced size
+                            img.thumbnail((max_dimension, max_dimension))
+                        img.load()
+                        webp_buffer = io.BytesIO()
+                        # Use quality 80 - good balance between size and quality
+                        img.save(webp_buffer, "WEBP", quality=80, method=4)
+                        webp_data = webp_buffer.getbuffer()
 
-            # Create temporary filenames without spaces - using a different naming strategy for special chars
-            if has_special_chars:
-                print(
-                    f"File has spaces or special characters, using special handling: {source_file}"
-                )
-                # Create sanitized temp filenames that avoid special characters
-                temp_input = os.path.join(
-                    temp_dir, f"input_{int(time.time())}_{os.urandom(4).hex()}{ext}"
-                )
-                temp_output = os.path.join(
-                    temp_dir, f"output_{int(time.time())}_{os.urandom(4).hex()}.webp"
-                )
-                temp_final = os.path.join(
-                    temp_dir, f"final_{int(time.time())}_{os.urandom(4).hex()}{ext}"
+                if pyvips is not None:
+                    webp_data = vips_encode(
+                        source_file, max_dimension if needs_resize else None
+                    )
+                elif not _PILLOW_HAS_WEBP:
+                    # Pillow was built without libwebp, use the cwebp tool instead
+                    webp_data = cwebp_encode(source_file, resize)
+            except Exception as webp_error:
+                log.error(f"WebP conversion error: {str(webp_error)}")
+                webp_data = None
+
+            # Optionally try AVIF as well and keep whichever encode is smaller
+            encoded_data = webp_data
+            if use_avif:
+                avif_data = avif_encode(
+                    source_file, max_dimension if needs_resize else None
                 )
+                if avif_data and (not webp_data or len(avif_data) < len(webp_data)):
+                    encoded_data = avif_data
+
+            # If conversion was successful, the caller decides which file to keep
+            if encoded_data:
+                return input_size, encoded_data
             else:
-                # Standard temp filenames for regular files
-                temp_input = os.path.join(
-                    temp_dir, f"input_{int(time.time())}_{os.urandom(4).hex()}{ext}"
-                )
-                temp_output = os.path.join(
-                    temp_dir, f"output_{int(time.time())}_{os.urandom(4).hex()}.webp"
+                # If conversion failed, fall back to direct copy
+                log.warning(
+                    f"Conversion failed, falling back to direct copy for: {source_file}"
                 )
-                temp_final = None  # Not needed for regular files
+                fast_copy(source_file, dest_file)
+                log.info(f"Copied: {source_file} -> {dest_file}")
+                return True
+        else:
+            # For unsupported formats, just copy
+            fast_copy(source_file, dest_file)
+            log.info(f"Copied (unsupported format): {source_file} -> {dest_file}")
+            return True
+
+    except Exception as e:
+        log.error(f"Error optimizing image {source_file}: {str(e)}")
+        # If a partial output file was created, remove it
+        if os.path.exists(dest_file):
+            try:
+                os.remove(dest_file)
+            except:
+                pass
+        return False
 
+
+def write_image(source_file, dest_file, input_size, encoded_data, keep_encoded):
+    """
+    Write the result of encode_image to dest_file.
+
+    Args:
+        source_file: Path to the source image file
+        dest_file: Path to the destination file
+        input_size: Size of the source file in bytes
+        encoded_data: The encoded WebP or AVIF image
+        keep_encoded: If True write the encoded image, otherwise copy the smaller original
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    try:
+        if not keep_encoded:
+            # Original is smaller, use it
+            fast_copy(source_file, dest_file)
+            log.info(
+                f"Original file is smaller, copied: {source_file} ({input_size/1024:.2f}KB) -> {dest_file}"
+            )
+        else:
+            # Encoded image is smaller, write it to the destination
+            with open(dest_file, "wb") as f:
+                f.write(encoded_data)
+            log.info(
+                f"Optimized: {source_file} ({input_size/1024:.2f}KB) -> {dest_file} ({len(encoded_data)/1024:.2f}KB)"
+            )
+        return True
+    except Exception as e:
+        log.error(f"Error optimizing image {source_file}: {str(e)}")
+        # If a partial output file was created, remove it
+        if os.path.exists(dest_file):
+            try:
+                os.remove(dest_file)
+            except:
+                pass
+        return False
+
+
+def optimize_image_batch(pairs, max_dimension=None, use_avif=False):
+    """
+    Convert a batch of PNG or JPG/JPEG images to WebP while keeping original extensions.
+    All images are encoded in memory first, then their sizes are compared to decide
+    whether the WebP or the original is kept.
+
+    Args:
+        pairs: List of (source_file, dest_file) tuples
+        max_dimension: If set, downscale images so neither side exceeds this many pixels
+        use_avif: If True, also try AVIF and use it where it beats WebP
+
+    Returns:
+        list: True/False result for every pair, in order
+    """
+    results = [False] * len(pairs)
+    pending = []
+    for index, (source_file, dest_file) in enumerate(pairs):
+        encoded = encode_image(source_file, dest_file, max_dimension, use_avif)
+        if isinstance(encoded, tuple):
+            pending.append((index, *encoded))
+        else:
+            results[index] = encoded
+
+    # Keep the WebP only where it isn't larger than the original
+    for index, input_size, encoded_data in pending:
+        source_file, dest_file = pairs[index]
+        results[index] = write_image(
+            source_file,
+            dest_file,
+            input_size,
+            encoded_data,
+            len(encoded_data) <= input_size,
+        )
+
+    return results
+
+
+def optimize_image(source_file, dest_file, max_dimension=None, use_avif=False):
+    """
+    Convert PNG or JPG/JPEG to WebP format while keeping original extension.
+    The image type is detected from the file contents, not the extension.
+
+    Args:
+        source_file: Path to the source image file
+        dest_file: Path to the destination file (should have original extension)
+        max_dimension: If set, downscale images so neither side exceeds this many pixels
+        use_avif: If True, use AVIF instead of WebP when it is smaller
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    return optimize_image_batch([(source_file, dest_file)], max_dimension, use_avif)[0]
+
+
+def _rmtree_onerror(func, path, _):
+    """
+    shutil.rmtree error handler: make read-only files writable and try again,
+    give up silently if that fails too.
+    """
+    try:
+        os.chmod(path, 0o666)
+        func(path)
+    except OSError:
+        pass
+
+
+def get_work_dir():
+    """
+    Get the scratch directory of this process, creating it on first use.
+    The directory is removed again when the process exits.
+
+    Returns:
+        str: Path to the scratch directory
+    """
+    global _work_dir
+    with _init_lock:
+        if _work_dir is None:
+            _work_dir = tempfile.mkdtemp(prefix="mediaopt_")
+            # Finalizers also run in pool workers, which exit without calling atexit handlers
+            multiprocessing.util.Finalize(
+                None,
+                shutil.rmtree,
+                args=(_work_dir,),
+                kwargs={"onerror": _rmtree_onerror},
+                exitpriority=0,
+            )
+    return _work_dir
+
+
+def load_ocrmypdf():
+    """
+    Import the ocrmypdf API once per process, so its startup cost is paid per
+    worker instead of per PDF.
+
+    Returns:
+        module: The ocrmypdf module, or None if it isn't installed
+    """
+    global _ocrmypdf, _ocrmypdf_loaded
+    with _init_lock:
+        if not _ocrmypdf_loaded:
             try:
-                # Copy the source file to our temp location
-                shutil.copy2(source_file, temp_input)
-                print(f"Converting {source_file} to WebP...")
+                import ocrmypdf
 
-                conversion_success = False
+                _ocrmypdf = ocrmypdf
+            except ImportError:
+                _ocrmypdf = None
+            _ocrmypdf_loaded = True
+    return _ocrmypdf
 
-                # Different conversion approaches based on whether we have special characters
-                if has_special_chars:
-                    try:
-                        # Try using direct subprocess for files with special characters
-                        print("Using subprocess for file with special characters...")
-
-                        # First check if cwebp is available
-                        which_result = subprocess.run(
-                            ["which", "cwebp"], capture_output=True, text=True
-                        )
 
-                        if which_result.returncode == 0:
-                            cwebp_path = which_result.stdout.strip()
-                            print(f"Found cwebp at: {cwebp_path}")
-
-                            # Use subprocess with properly quoted filenames
-                            subprocess_result = subprocess.run(
-                                [cwebp_path, "-q", "80", temp_input, "-o", temp_output],
-                                capture_output=True,
-                                text=True,
-                            )
-
-                            if subprocess_result.returncode == 0:
-                                print("Direct subprocess conversion successful")
-                                conversion_success = True
-                            else:
-                                print(
-                                    f"Direct subprocess conversion failed: {subprocess_result.stderr}"
-                                )
-                        else:
-                            print(
-                                "cwebp not found in PATH, falling back to pillow conversion"
-                            )
-
-                            # If cwebp is not available, try using Pillow for conversion
-                            try:
-                                from PIL import Image
-
-                                img = Image.open(temp_input)
-                                img.save(temp_output, "WEBP", quality=80)
-                                conversion_success = True
-                                print("Pillow conversion successful")
-                            except ImportError:
-                                print("Pillow not available")
-                            except Exception as pillow_error:
-                                print(f"Pillow conversion error: {str(pillow_error)}")
-                    except Exception as special_error:
-                        print(
-                            f"Special handling conversion error: {str(special_error)}"
-                        )
-                else:
-                    # Standard conversion using webptools
-                    try:
-                        # Use quality 80 - good balance between size and quality
-                        exit_code = cwebp(
-                            input_image=temp_input,
-                            output_image=temp_output,
-                            option="-q 80",
-                        )
+def run_ocrmypdf(source_file, output_file, force_ocr=False):
+    """
+    Optimize a PDF in-process with the ocrmypdf API.
 
-                        if isinstance(exit_code, dict) and "exit_code" in exit_code:
-                            exit_code = exit_code["exit_code"]
-
-                        # Print more detailed debug info
-                        print(f"WebP conversion exit code: {exit_code}")
-
-                        if exit_code == 0:
-                            conversion_success = True
-                        else:
-                            print(
-                                f"WebP conversion failed for {source_file}, exit code: {exit_code}"
-                            )
-
-                            # Try direct conversion with subprocess as fallback
-                            try:
-                                print("Trying fallback conversion with subprocess...")
-                                # Check if cwebp command exists
-                                which_result = subprocess.run(
-                                    ["which", "cwebp"], capture_output=True, text=True
-                                )
-                                if which_result.returncode == 0:
-                                    cwebp_path = which_result.stdout.strip()
-                                    print(f"Found cwebp at: {cwebp_path}")
-
-                                    # Use subprocess directly
-                                    subprocess_result = subprocess.run(
-                                        [
-                                            cwebp_path,
-                                            "-q",
-                                            "80",
-                                            temp_input,
-                                            "-o",
-                                            temp_output,
-                                        ],
-                                        capture_output=True,
-                                        text=True,
-                                    )
-
-                                    if subprocess_result.returncode == 0:
-                                        print("Fallback conversion successful!")
-                                        conversion_success = True
-                                    else:
-                                        print(
-                                            f"Fallback conversion failed: {subprocess_result.stderr}"
-                                        )
-                                else:
-                                    print("cwebp command not found in PATH")
-                            except Exception as fallback_error:
-                                print(
-                                    f"Fallback conversion error: {str(fallback_error)}"
-                                )
-                    except Exception as webp_error:
-                        print(f"WebP conversion error: {str(webp_error)}")
-
-                # If conversion was successful, check the output
-                if (
-                    conversion_success
-                    and os.path.exists(temp_output)
-                    and os.path.getsize(temp_output) > 0
-                ):
-                    # Compare file sizes
-                    input_size = os.path.getsize(source_file)
-                    webp_size = os.path.getsize(temp_output)
-
-                    if input_size < webp_size:
-                        # Original is smaller, use it
-                        shutil.copy2(source_file, dest_file)
-                        print(
-                            f"Original file is smaller, copied: {source_file} ({input_size/1024:.2f}KB) -> {dest_file}"
-                        )
-                    else:
-                        # WebP is smaller, copy it to the destination
-                        shutil.copy2(temp_output, dest_file)
-                        print(
-                            f"Optimized: {source_file} ({input_size/1024:.2f}KB) -> {dest_file} ({webp_size/1024:.2f}KB)"
-                        )
-                    return True
-                else:
-                    # If conversion failed, fall back to direct copy
-                    print(
-                        f"Conversion failed, falling back to direct copy for: {source_file}"
-                    )
-                    shutil.copy2(source_file, dest_file)
-                    print(f"Copied: {source_file} -> {dest_file}")
-                    return True
-            finally:
-                # Clean up temporary files
-                if os.path.exists(temp_input):
-                    os.remove(temp_input)
-                if os.path.exists(temp_output):
-                    os.remove(temp_output)
-                if temp_final and os.path.exists(temp_final):
-                    os.remove(temp_final)
-                try:
-                    os.rmdir(temp_dir)  # Remove temp dir if empty
-                except:
-                    pass  # It's ok if we can't remove it
-        else:
-            # For unsupported formats, just copy
-            shutil.copy2(source_file, dest_file)
-            print(f"Copied (unsupported format): {source_file} -> {dest_file}")
-            return True
+    Args:
+        source_file: Path to the source PDF file
+        output_file: Path to write the optimized PDF to
+        force_ocr: If True, rasterize and OCR all pages instead of skipping pages with text
 
-    except Exception as e:
-        print(f"Error optimizing image {source_file}: {str(e)}")
-        # If a partial output file was created, remove it
-        if os.path.exists(dest_file):
-            try:
-                os.remove(dest_file)
-            except:
-                pass
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    ocrmypdf = load_ocrmypdf()
+    try:
+        # optimize=3: Maximum optimization level
+        # jpeg_quality=75: Good balance for JPEG quality
+        # jobs/use_threads: PDFs share the CPU pool with videos, use as many threads as an encode
+        result = ocrmypdf.ocr(
+            source_file,
+            output_file,
+            optimize=3,
+            skip_text=not force_ocr,  # Skip OCR if already has text
+            force_ocr=force_ocr,
+            jpeg_quality=75,
+            output_type="pdf",
+            progress_bar=False,
+            jobs=VIDEO_THREADS,
+            use_threads=True,
+        )
+        return result == ocrmypdf.ExitCode.ok
+    except Exception as ocr_error:
+        log.error(f"ocrmypdf optimization failed: {ocr_error}")
         return False
 
 
@@ -522,141 +1359,57 @@ def optimize_pdf(source_file, dest_file):
         bool: True if successful, False otherwise
     """
     try:
-        # Check if destination file already exists - skip if it does
-        if os.path.exists(dest_file) and os.path.getsize(dest_file) > 0:
-            print(f"Skipping existing PDF file: {dest_file}")
-            return True
-
         # Validate input file first
         if not os.path.exists(source_file) or os.path.getsize(source_file) == 0:
-            print(f"Invalid PDF file (missing or empty): {source_file}")
+            log.error(f"Invalid PDF file (missing or empty): {source_file}")
             return False
 
         # Skip hidden files
         if os.path.basename(source_file).startswith("._"):
-            print(f"Skipping hidden PDF file: {source_file}")
+            log.info(f"Skipping hidden PDF file: {source_file}")
             return False
 
         # Get input file size immediately and display it
         input_size = os.path.getsize(source_file)
-        print(
+        log.info(
             f"Processing PDF: {source_file} (Size: {input_size/1024:.2f}KB / {input_size/1024/1024:.2f}MB)"
         )
 
-        # Create temporary directory for processing
-        temp_dir = os.path.join(
-            os.path.dirname(dest_file), f".tmp_pdf_conversion_{int(time.time())}"
-        )
-        os.makedirs(temp_dir, exist_ok=True)
-
-        # Temporary optimization file
-        temp_pdf = os.path.join(temp_dir, "optimized.pdf")
+        # Temporary optimization file, unique within this process's scratch directory
+        temp_pdf = os.path.join(get_work_dir(), f"{uuid.uuid4().hex}.pdf")
 
         try:
             # Check if ocrmypdf is installed (needed for JBIG2)
-            has_ocrmypdf = False
-            try:
-                subprocess.run(
-                    ["ocrmypdf", "--version"], capture_output=True, check=False
+            ocrmypdf = load_ocrmypdf()
+            if ocrmypdf is None:
+                log.warning(
+                    "ocrmypdf not found, JBIG2 compression may not be available"
                 )
-                has_ocrmypdf = True
-            except (FileNotFoundError, subprocess.SubprocessError):
-                print("ocrmypdf not found, JBIG2 compression may not be available")
 
-            print(f"Optimizing PDF: {source_file}")
+            log.info(f"Optimizing PDF: {source_file}")
 
             # Method 1: Use ocrmypdf if available (it has JBIG2 and image optimization)
-            if has_ocrmypdf:
-                print("Using ocrmypdf for optimization with JBIG2/JPEG2000 support")
-                # --redo-ocr: Re-run OCR on any text (ensures we can reprocess PDFs)
-                # --optimize 3: Maximum optimization level
-                # --jbig2-lossy: Enable lossy JBIG2 for monochrome images
-                # --jpeg-quality 75: Good balance for JPEG quality
-                result = subprocess.run(
-                    [
-                        "ocrmypdf",
-                        "--optimize",
-                        "3",
-                        "--skip-text",  # Skip OCR if already has text
-                        "--jbig2-lossy",
-                        "--jpeg-quality",
-                        "75",
-                        "--output-type",
-                        "pdf",
-                        "--quiet",
-                        source_file,
-                        temp_pdf,
-                    ],
-                    capture_output=True,
-                    text=True,
-                )
+            if ocrmypdf is not None:
+                log.info("Using ocrmypdf for optimization with JBIG2/JPEG2000 support")
+                optimization_success = run_ocrmypdf(source_file, temp_pdf)
 
-                if result.returncode != 0:
+                if not optimization_success:
                     # Handle case where optimization failed but PDF might be image-only
-                    print(f"Standard optimization failed: {result.stderr}")
-                    print("Trying with force-ocr option...")
-
-                    result = subprocess.run(
-                        [
-                            "ocrmypdf",
-                            "--optimize",
-                            "3",
-                            "--force-ocr",
-                            "--jbig2-lossy",
-                            "--jpeg-quality",
-                            "75",
-                            "--output-type",
-                            "pdf",
-                            "--quiet",
-                            source_file,
-                            temp_pdf,
-                        ],
-                        capture_output=True,
-                        text=True,
+                    log.warning("Trying with force-ocr option...")
+                    optimization_success = run_ocrmypdf(
+                        source_file, temp_pdf, force_ocr=True
                     )
 
-                optimization_success = result.returncode == 0
-
             # Method 2: Fallback to pikepdf and manual processing
             else:
-                # Open the PDF with PyMuPDF (fitz) for analyzing images
-                pdf_doc = fitz.open(source_file)
-                needs_optimization = False
-
-                # Scan PDF to see if it has images that need optimization
-                for page_num in range(len(pdf_doc)):
-                    page = pdf_doc[page_num]
-                    image_list = page.get_images(full=True)
-
-                    for img_index, img_info in enumerate(image_list):
-                        xref = img_info[0]
-                        base_image = pdf_doc.extract_image(xref)
-                        image_bytes = base_image["image"]
-
-                        # Check image compression type
-                        img_type = base_image["colorspace"]
-                        compression = base_image.get("cs-name", "")
-
-                        # If not already JPEG2000 or JBIG2, mark for optimization
-                        if "JP2" not in compression and "JBIG2" not in compression:
-                            needs_optimization = True
-                            break
-
-                    if needs_optimization:
-                        break
-
-                if not needs_optimization:
-                    print(f"PDF already uses optimal compression: {source_file}")
-                    shutil.copy2(source_file, dest_file)
-                    return True
-
+                # No image pre-scan, the size comparison below decides which file to keep
                 # Use pikepdf for optimization
                 with pikepdf.open(source_file) as pdf:
                     # Save with optimization settings
                     pdf.save(
                         temp_pdf,
                         compress_streams=True,
-                        object_streams="generate",
+                        object_stream_mode=pikepdf.ObjectStreamMode.generate,
                         linearize=False,
                     )
 
@@ -672,339 +1425,853 @@ def optimize_pdf(source_file, dest_file):
                     (size_diff / input_size) * 100 if input_size > 0 else 0
                 )
 
-                print(
+                log.info(
                     f"Input size: {input_size/1024:.2f}KB / {input_size/1024/1024:.2f}MB"
                 )
-                print(
+                log.info(
                     f"Output size: {output_size/1024:.2f}KB / {output_size/1024/1024:.2f}MB"
                 )
 
                 if size_diff > 0:
-                    print(
+                    log.info(
                         f"Size reduction: {size_diff/1024:.2f}KB ({reduction_percent:.1f}%)"
                     )
                 else:
-                    print(
+                    log.info(
                         f"Size increase: {-size_diff/1024:.2f}KB ({-reduction_percent:.1f}%)"
                     )
 
                 if input_size < output_size:
                     # Original is smaller, use it
-                    print(f"Original PDF is smaller, copying original")
-                    shutil.copy2(source_file, dest_file)
+                    log.info(f"Original PDF is smaller, copying original")
+                    fast_copy(source_file, dest_file)
                 else:
                     # Optimized is smaller, use it
-                    print(f"Using optimized PDF (smaller than original)")
-                    shutil.copy2(temp_pdf, dest_file)
+                    log.info(f"Using optimized PDF (smaller than original)")
+                    fast_copy(temp_pdf, dest_file)
 
                 return True
             else:
-                print(
+                log.warning(
                     f"PDF optimization failed, falling back to direct copy: {source_file}"
                 )
-                shutil.copy2(source_file, dest_file)
+                fast_copy(source_file, dest_file)
                 # Display size information even for direct copies
                 output_size = os.path.getsize(dest_file)
-                print(
+                log.info(
                     f"Copied without optimization: {input_size/1024:.2f}KB -> {output_size/1024:.2f}KB"
                 )
                 return True
 
         finally:
-            # Clean up temporary files with timeouts and better error handling
+            # Remove the temporary PDF, the scratch directory is removed when the process exits
             try:
-                # First try to remove the temporary PDF file if it exists
-                if os.path.exists(temp_pdf):
-                    try:
-                        os.remove(temp_pdf)
-                        print(f"Removed temporary PDF: {temp_pdf}")
-                    except (PermissionError, OSError) as cleanup_error:
-                        print(
-                            f"Failed to remove temporary PDF {temp_pdf}: {cleanup_error}"
-                        )
-                        # Try to make the file writable in case it's read-only
-                        try:
-                            os.chmod(temp_pdf, 0o666)
-                            os.remove(temp_pdf)
-                            print(f"Removed temporary PDF after chmod: {temp_pdf}")
-                        except Exception as e:
-                            print(f"Still failed to remove temporary PDF: {e}")
-
-                # Then try to remove the temporary directory
-                if os.path.exists(temp_dir):
-                    try:
-                        # First check if directory is empty
-                        files_in_dir = os.listdir(temp_dir)
-                        if not files_in_dir:
-                            os.rmdir(temp_dir)
-                            print(f"Removed temporary directory: {temp_dir}")
-                        else:
-                            # If directory is not empty, try to remove all files first
-                            print(
-                                f"Temporary directory not empty, trying to clean up: {temp_dir}"
-                            )
-                            for filename in files_in_dir:
-                                file_path = os.path.join(temp_dir, filename)
-                                try:
-                                    if os.path.isfile(file_path) or os.path.islink(
-                                        file_path
-                                    ):
-                                        os.unlink(file_path)
-                                    elif os.path.isdir(file_path):
-                                        shutil.rmtree(file_path)
-                                except Exception as e:
-                                    print(f"Failed to delete {file_path}: {e}")
-
-                            # Try again to remove the directory
-                            if not os.listdir(temp_dir):
-                                os.rmdir(temp_dir)
-                                print(
-                                    f"Removed temporary directory after cleanup: {temp_dir}"
-                                )
-                            else:
-                                print(
-                                    f"Could not fully clean temporary directory: {temp_dir}"
-                                )
-                    except Exception as dir_error:
-                        print(f"Failed to remove temporary directory: {dir_error}")
-                        # Don't let this stop the process
-            except Exception as cleanup_error:
-                print(f"Error during cleanup: {cleanup_error}")
-                # Continue with execution regardless of cleanup errors
+                os.remove(temp_pdf)
+            except FileNotFoundError:
+                pass
+            except OSError as cleanup_error:
+                log.error(f"Failed to remove temporary PDF {temp_pdf}: {cleanup_error}")
 
     except Exception as e:
-        print(f"Error optimizing PDF {source_file}: {str(e)}")
-        traceback.print_exc()  # Add this to get full error trace
+        # log.exception adds the full error trace
+        log.exception(f"Error optimizing PDF {source_file}: {str(e)}")
         # If a partial output file was created, remove it
         if os.path.exists(dest_file):
             try:
                 os.remove(dest_file)
-                print(f"Removed partial output file: {dest_file}")
+                log.info(f"Removed partial output file: {dest_file}")
             except Exception as cleanup_error:
-                print(f"Failed to remove partial output file: {cleanup_error}")
+                log.error(f"Failed to remove partial output file: {cleanup_error}")
+        return False
+
+
+def ensure_dir(path):
+    """
+    Create a directory and its parents unless this process already did so.
+    Saves a stat call for every file written into the same directory.
+
+    Args:
+        path: Directory that has to exist
+    """
+    if path not in _ensured_dirs:
+        os.makedirs(path, exist_ok=True)
+        _ensured_dirs.add(path)
+
+
+def dest_done(path, dir_names=None):
+    """
+    Check if a destination file was already written, with a single stat call.
+
+    Args:
+        path: Path to the destination file
+        dir_names: Optional set of the names in the destination directory, files
+            missing from it are reported as not done without any stat call
+
+    Returns:
+        bool: True if the file exists and is not empty
+    """
+    if dir_names is not None and os.path.basename(path) not in dir_names:
+        return False
+    try:
+        return os.stat(path).st_size > 0
+    except FileNotFoundError:
         return False
 
 
-def move_gamelists(input_dir, output_dir):
+def list_dir(path):
+    """
+    List a directory with os.scandir.
+
+    Returns:
+        list: DirEntry objects of the directory
+    """
+    with os.scandir(path) as it:
+        return list(it)
+
+
+def iwalk(top, inode_order=False, executor=None):
+    """
+    Walk a directory tree with os.scandir. Like os.walk, but every directory comes
+    with its DirEntry objects, whose is_dir()/is_file() don't need an extra stat.
+    Entries removed from the list by the caller are not descended into.
+
+    Args:
+        top: Directory to walk
+        inode_order: If True, sort entries by inode and visit the directories of the
+            whole tree in inode order, which saves seeks on hard disks
+        executor: Optional ThreadPoolExecutor that lists the pending directories in
+            parallel ahead of the walk, the order of the results stays the same
+
+    Yields:
+        tuple: (dir_path, entries) for top and every directory below it, top-down
+    """
+
+    def schedule(path):
+        # Start listing a directory in the background, None lists it when it's reached
+        return executor.submit(list_dir, path) if executor is not None else None
+
+    # Directories still to visit as (inode, path, listing), a heap with inode_order,
+    # else a stack. Paths are unique so the listing futures are never compared
+    pending = [(0, top, schedule(top))]
+    while pending:
+        if inode_order:
+            _, dir_path, listing = heapq.heappop(pending)
+        else:
+            _, dir_path, listing = pending.pop()
+
+        try:
+            entries = listing.result() if listing is not None else list_dir(dir_path)
+        except OSError as walk_error:
+            log.error(f"Cannot read directory {dir_path}: {walk_error}")
+            continue
+
+        if inode_order:
+            entries.sort(key=os.DirEntry.inode)
+
+        yield dir_path, entries
+
+        # Like os.walk, symlinked directories are listed but not followed
+        subdirs = [
+            entry for entry in entries if entry.is_dir() and not entry.is_symlink()
+        ]
+        if inode_order:
+            for entry in subdirs:
+                heapq.heappush(
+                    pending, (entry.inode(), entry.path, schedule(entry.path))
+                )
+        else:
+            # Reversed so the stack hands them out in listing order
+            pending.extend(
+                (0, entry.path, schedule(entry.path)) for entry in reversed(subdirs)
+            )
+
+
+def make_walk_executor(walk_threads):
+    """
+    Create the thread pool that lists directories ahead of iwalk.
+
+    Args:
+        walk_threads: Number of threads, 0 or None walks without threads
+
+    Returns:
+        Context manager giving a ThreadPoolExecutor or None
+    """
+    if not walk_threads:
+        return contextlib.nullcontext()
+    return ThreadPoolExecutor(max_workers=walk_threads)
+
+
+def walk_media(media_root, inode_order=False, executor=None):
+    """
+    Walk the subfolders of a media folder and yield every file in them. Files
+    directly inside media_root are not part of any subfolder and are skipped.
+
+    Args:
+        media_root: Path to a "media" folder
+        inode_order: If True, walk in inode order, see iwalk
+        executor: Optional ThreadPoolExecutor listing directories ahead, see iwalk
+
+    Yields:
+        tuple: (subfolder, rel_dir, entry) with the name of the subfolder, the
+        directory relative to it ("" for the subfolder itself) and the file's DirEntry
+    """
+    subfolders = [entry for entry in list_dir(media_root) if entry.is_dir()]
+    if inode_order:
+        subfolders.sort(key=os.DirEntry.inode)
+
+    for subfolder in subfolders:
+        prefix_length = len(subfolder.path) + 1
+        for dir_path, entries in iwalk(subfolder.path, inode_order, executor):
+            rel_dir = dir_path[prefix_length:]
+            for entry in entries:
+                if not entry.is_dir():
+                    yield subfolder.name, rel_dir, entry
+
+
+def move_gamelists(input_dir, output_dir, inode_order=False, walk_threads=0):
     """
     Recursively scan through input_dir for gamelist.xml files and move them to
     output_dir/gamelists/ while maintaining the original folder structure.
+    With inode_order, directories are walked in inode order. With walk_threads,
+    that many threads list directories ahead of the walk.
     """
     # Create the gamelists directory in the output folder if it doesn't exist
     gamelists_dir = os.path.join(output_dir, "gamelists")
-    if not os.path.exists(gamelists_dir):
-        os.makedirs(gamelists_dir)
+    ensure_dir(gamelists_dir)
 
     # Count for reporting
-    files_moved = 0
     files_skipped = 0
 
+    # Gamelists to copy, collected during the walk and copied together
+    pairs = []
+
+    # Walk through the directory tree
+    with make_walk_executor(walk_threads) as walk_executor:
+        for root, entries in iwalk(input_dir, inode_order, walk_executor):
+            for entry in entries:
+                if entry.name == "gamelist.xml" and not entry.is_dir():
+                    file = entry.name
+
+                    # Get the source file path
+                    source_file = entry.path
+
+                    # Calculate the relative path from input_dir
+                    rel_path = os.path.relpath(root, input_dir)
+
+                    # Create the destination directory
+                    dest_dir = os.path.join(gamelists_dir, rel_path)
+                    ensure_dir(dest_dir)
+
+                    # Set the destination file path
+                    dest_file = os.path.join(dest_dir, file)
+
+                    # Check if the file already exists in destination
+                    if dest_done(dest_file):
+                        log.info(f"Skipping existing gamelist: {dest_file}")
+                        files_skipped += 1
+                        continue
+
+                    pairs.append((source_file, dest_file, entry))
+
+    # Copy the files in threads, these small files are bound by per-file latency
+    files_moved = copy_many(pairs).count(True)
+
+    log.log(NOTICE, f"Total gamelist.xml files moved: {files_moved}")
+    log.log(NOTICE, f"Total gamelist.xml files skipped: {files_skipped}")
+
+
+def open_manifest(output_dir):
+    """
+    Open the manifest of processed files in output_dir, creating it if needed.
+    The manifest lets reruns skip finished files without touching the destination.
+    """
+    manifest = sqlite3.connect(os.path.join(output_dir, MANIFEST_NAME))
+    manifest.execute(
+        "CREATE TABLE IF NOT EXISTS done "
+        "(src TEXT PRIMARY KEY, dest TEXT, mtime REAL, size INTEGER)"
+    )
+    return manifest
+
+
+def manifest_is_done(manifest, source_file, dest_file, source_entry=None):
+    """
+    Check if source_file was already processed into dest_file and hasn't changed since.
+    With the DirEntry of source_file, its cached stat result is used.
+    """
+    row = manifest.execute(
+        "SELECT dest, mtime, size FROM done WHERE src = ?",
+        (os.path.abspath(source_file),),
+    ).fetchone()
+    if row is None:
+        return False
+    st = source_stat(source_file, source_entry)
+    return row == (os.path.abspath(dest_file), st.st_mtime, st.st_size)
+
+
+def manifest_mark_done(manifest, source_file, dest_file, source_entry=None):
+    """
+    Record that source_file was processed into dest_file. The manifest is
+    committed every MANIFEST_COMMIT_INTERVAL seconds, so a crash or Ctrl-C
+    keeps the files finished so far.
+    With the DirEntry of source_file, its cached stat result is used.
+    """
+    global _manifest_commit_time
+    st = source_stat(source_file, source_entry)
+    manifest.execute(
+        "INSERT OR REPLACE INTO done VALUES (?, ?, ?, ?)",
+        (
+            os.path.abspath(source_file),
+            os.path.abspath(dest_file),
+            st.st_mtime,
+            st.st_size,
+        ),
+    )
+
+    # Commit now and then instead of once at the end of the run
+    now = time.monotonic()
+    if now - _manifest_commit_time >= MANIFEST_COMMIT_INTERVAL:
+        manifest.commit()
+        _manifest_commit_time = now
+
+
+@dataclass
+class MediaCounts:
+    """
+    Counters reported at the end of copy_media_folders.
+    """
+
+    media_folders: int = 0
+    skipped: int = 0
+    files_copied: int = 0
+    videos_optimized: int = 0
+    images_optimized: int = 0
+
+
+def iter_media_jobs(
+    input_dir,
+    downloaded_media_dir,
+    optimize_videos,
+    counts,
+    manifest=None,
+    inode_order=False,
+    walk_executor=None,
+):
+    """
+    Recursively scan through input_dir for 'media' folders and yield a job for every
+    file that needs to be processed. Destination directories are created on the way.
+
+    Args:
+        input_dir: Directory to scan recursively
+        downloaded_media_dir: Root of the destination media folders
+        optimize_videos: If True, MP4 files are yielded as video jobs
+        counts: MediaCounts, media_folders and skipped are updated in place
+        manifest: Optional manifest connection, files recorded in it are skipped
+        inode_order: If True, walk the directories in inode order, see iwalk
+        walk_executor: Optional ThreadPoolExecutor listing directories ahead, see iwalk
+
+    Yields:
+        tuple: (kind, source_file, dest_file, source_entry) where kind is "video",
+        "pdf", "image" or "copy" and source_entry is the file's DirEntry
+    """
     # Walk through the directory tree
-    for root, _, files in os.walk(input_dir):
-        for file in files:
-            if file == "gamelist.xml":
-                # Get the source file path
-                source_file = os.path.join(root, file)
-
-                # Calculate the relative path from input_dir
-                rel_path = os.path.relpath(root, input_dir)
-
-                # Create the destination directory
-                dest_dir = os.path.join(gamelists_dir, rel_path)
-                if not os.path.exists(dest_dir):
-                    os.makedirs(dest_dir)
-
-                # Set the destination file path
-                dest_file = os.path.join(dest_dir, file)
-
-                # Check if the file already exists in destination
-                if os.path.exists(dest_file) and os.path.getsize(dest_file) > 0:
-                    print(f"Skipping existing gamelist: {dest_file}")
-                    files_skipped += 1
+    for root, entries in iwalk(input_dir, inode_order, walk_executor):
+        media_entries = [
+            entry for entry in entries if entry.name == "media" and entry.is_dir()
+        ]
+        for media_entry in media_entries:
+            # The media folder is walked below, the outer walk doesn't have to enter it
+            entries.remove(media_entry)
+
+            # Get full path to the media directory
+            media_dir_path = media_entry.path
+
+            # Get the parent folder name (e.g., "megadrive")
+            parent_folder = os.path.basename(root)
+
+            # Create destination directory for this system
+            dest_system_dir = os.path.join(downloaded_media_dir, parent_folder)
+            ensure_dir(dest_system_dir)
+
+            # Walk every file in the subfolders of the media directory in one pass
+            dest_key = None
+            for subfolder, rel_dir, file_entry in walk_media(
+                media_dir_path, inode_order, walk_executor
+            ):
+                # Build the destination directory once per source directory, with
+                # plain string joins since os.path.join is slow in this hot loop
+                if (subfolder, rel_dir) != dest_key:
+                    dest_key = (subfolder, rel_dir)
+                    dest_file_dir = f"{dest_system_dir}{os.sep}{subfolder}"
+                    if rel_dir:
+                        dest_file_dir = f"{dest_file_dir}{os.sep}{rel_dir}"
+                    # Created and listed when the first file misses the manifest,
+                    # so manifest reruns don't touch the destination at all
+                    dest_names = None
+
+                file = file_entry.name
+
+                # Skip macOS hidden files at the outset
+                if file.startswith("._"):
+                    log.info(
+                        f"Skipping macOS hidden file: {file} (completely bypassing all processing)"
+                    )
+                    counts.skipped += 1
+                    continue  # This should skip to the next file without further processing
+
+                # Get full path to source file
+                src_file_path = file_entry.path
+
+                # Look up the job kind by lowercase extension, other files are copied
+                stem, extension = os.path.splitext(file)
+                kind = _EXTENSION_KINDS.get(extension.lower(), "copy")
+                if kind == "video" and not optimize_videos:
+                    kind = "copy"
+                label = _KIND_LABELS[kind]
+
+                # Optimized videos get the .mkv extension
+                if kind == "video":
+                    dest_file_path = f"{dest_file_dir}{os.sep}{stem}.mkv"
+                else:
+                    dest_file_path = f"{dest_file_dir}{os.sep}{file}"
+
+                # Check if the manifest already has this file, the DirEntry caches the
+                # source's stat for both manifest calls
+                if manifest is not None and manifest_is_done(
+                    manifest, src_file_path, dest_file_path, file_entry
+                ):
+                    log.info(f"Skipping processed {label}: {dest_file_path}")
+                    counts.skipped += 1
+                    continue
+
+                # List the destination once, so new files need no stat on reruns
+                if dest_names is None:
+                    ensure_dir(dest_file_dir)
+                    dest_names = set(os.listdir(dest_file_dir))
+
+                # Plain copies check for an existing destination when they open it
+                if kind == "copy":
+                    yield kind, src_file_path, dest_file_path, file_entry
+                    continue
+
+                # Check if destination already exists, without a stat if it isn't listed
+                if dest_done(dest_file_path, dest_names):
+                    log.info(f"Skipping existing {label}: {dest_file_path}")
+                    counts.skipped += 1
+                    if manifest is not None:
+                        manifest_mark_done(
+                            manifest, src_file_path, dest_file_path, file_entry
+                        )
+                    continue
+
+                yield kind, src_file_path, dest_file_path, file_entry
+
+            counts.media_folders += 1
+
+
+def init_worker(
+    print_lock,
+    log_queue=None,
+    log_level=logging.INFO,
+    hevc_encoder=None,
+):
+    """
+    Initialize a pool worker process: share the console lock and log queue, reuse
+    the HEVC encoder detected by the parent and load the image plugins once instead
+    of per file. ocrmypdf is loaded by the first PDF a worker gets, see load_ocrmypdf.
+    """
+    global _print_lock, _hevc_encoder
+    _print_lock = print_lock
+    setup_logging(log_queue, log_level)
+    if hevc_encoder is not None:
+        _hevc_encoder = hevc_encoder
+    Image.init()
+
+
+def run_logged(log_queue, log_level, func, *args):
+    """
+    Configure logging like init_worker, then run func. Used as the target of a
+    separate process.
+    """
+    setup_logging(log_queue, log_level)
+    func(*args)
+
+
+def print_progress(message):
+    """
+    Print a progress line in place, holding the shared lock when running in a pool.
+    Progress is per-file output, so it's left out with --quiet.
+    """
+    if not log.isEnabledFor(logging.INFO):
+        return
+    if _print_lock is None:
+        print(message, end="\r", flush=True)
+        return
+    with _print_lock:
+        print(message, end="\r", flush=True)
+
+
+def run_media_job(
+    job, use_av1=False, use_hw_encoder=True, max_image_size=None, use_avif=False
+):
+    """
+    Process a single job produced by iter_media_jobs. The walk already skipped
+    finished destinations, so the optimizers don't check dest_file again.
+
+    Args:
+        job: (kind, source_file, dest_file) tuple of a video, PDF or image, plain
+            copies go through copy_many instead
+        use_av1: If True, use AV1 encoding for videos
+        use_hw_encoder: If False, always use x265 for HEVC encoding
+        max_image_size: If set, downscale images to at most this many pixels per side
+        use_avif: If True, use AVIF for images when it beats WebP
+
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    kind, source_file, dest_file = job
+    if kind == "video":
+        return optimize_video(source_file, dest_file, use_av1, use_hw_encoder)
+    if kind == "pdf":
+        if optimize_pdf(source_file, dest_file):
+            log.info(f"PDF processed: {source_file} -> {dest_file}")
+            return True
+        return False
+    return optimize_image(source_file, dest_file, max_image_size, use_avif)
+
+
+def copy_file(pair):
+    """
+    Copy a single (source_file, dest_file, source_entry) job, keeping file metadata.
+    source_entry is the source's DirEntry from the walk or None. Finished copies
+    already at dest_file are left alone.
+
+    Returns:
+        bool or None: True if copied, False on errors, None if dest_file already existed
+    """
+    source_file, dest_file, source_entry = pair
+    dest_fd = None
+    try:
+        dest_fd = reserve_dest(dest_file, source_file, source_entry)
+        if dest_fd is None:
+            log.info(f"Skipping existing file: {dest_file}")
+            return None
+        fast_copy(source_file, dest_file, dest_fd)
+        log.info(f"Copied: {source_file} -> {dest_file}")
+        return True
+    except Exception as e:
+        log.error(f"Error copying {source_file}: {str(e)}")
+        # If a partial output file was created, remove it
+        if dest_fd is not None:
+            try:
+                os.remove(dest_file)
+            except OSError:
+                pass
+        return False
+
+
+def copy_many_uring(pairs, executor):
+    """
+    Copy a batch of (source_file, dest_file, source_entry) jobs with io_uring. The read and write
+    of every small file are linked requests, and a whole batch of files is submitted
+    with a single system call. Large files and failed copies go through copy_file
+    on the threads of executor, alongside the io_uring batches.
+
+    Returns:
+        list: copy_file result for every pair in order, None if io_uring can't be used
+    """
+    ring = liburing.Ring()
+    try:
+        liburing.io_uring_queue_init(2 * URING_BATCH_SIZE, ring)
+    except OSError as uring_error:
+        log.warning(f"io_uring is not available ({uring_error}), copying with threads")
+        return None
+
+    cqe = liburing.Cqe()
+    results = [False] * len(pairs)
+    # Futures of the copies handed to the threads, by index
+    threaded = {}
+    try:
+        for start in range(0, len(pairs), URING_BATCH_SIZE):
+            # (index, source fd, destination fd, buffer) of every file in this batch
+            batch = []
+            for index in range(start, min(start + URING_BATCH_SIZE, len(pairs))):
+                source_file, dest_file, source_entry = pairs[index]
+                try:
+                    size = source_stat(source_file, source_entry).st_size
+                    if size == 0 or size > URING_MAX_FILE_SIZE:
+                        threaded[index] = executor.submit(copy_file, pairs[index])
+                        continue
+                    fd_in = os.open(source_file, os.O_RDONLY)
+                    try:
+                        fd_out = reserve_dest(dest_file, source_file, source_entry)
+                    except OSError:
+                        os.close(fd_in)
+                        raise
+                    if fd_out is None:
+                        os.close(fd_in)
+                        log.info(f"Skipping existing file: {dest_file}")
+                        results[index] = None
+                        continue
+                except OSError as open_error:
+                    log.error(f"Error copying {source_file}: {str(open_error)}")
                     continue
 
-                # Move the file
-                shutil.copy2(source_file, dest_file)
-                print(f"Moved: {source_file} -> {dest_file}")
-                files_moved += 1
+                # The write is linked to the read, so it only runs after a full read
+                buffer = bytearray(size)
+                sqe = liburing.io_uring_get_sqe(ring)
+                liburing.io_uring_prep_read(sqe, fd_in, buffer, 0)
+                liburing.io_uring_sqe_set_flags(sqe, liburing.IOSQE_IO_LINK)
+                liburing.io_uring_sqe_set_data64(sqe, 2 * len(batch))
+                sqe = liburing.io_uring_get_sqe(ring)
+                liburing.io_uring_prep_write(sqe, fd_out, buffer, 0)
+                liburing.io_uring_sqe_set_data64(sqe, 2 * len(batch) + 1)
+                batch.append((index, fd_in, fd_out, buffer))
+
+            if not batch:
+                continue
+
+            liburing.io_uring_submit_and_wait(ring, 2 * len(batch))
+
+            # Odd user data marks the write of a file, the copy worked if it wrote everything
+            written = [False] * len(batch)
+            for _ in range(2 * len(batch)):
+                liburing.io_uring_wait_cqe(ring, cqe)
+                entry = cqe[0]
+                user_data = entry.user_data
+                try:
+                    res = entry.res
+                except OSError:
+                    # Failed or cancelled because the linked read failed
+                    res = -1
+                liburing.io_uring_cqe_seen(ring, entry)
+                if user_data % 2:
+                    written[user_data // 2] = res == len(batch[user_data // 2][3])
+
+            for (index, fd_in, fd_out, _), success in zip(batch, written):
+                if not success:
+                    # Empty the partial copy so copy_file doesn't take it as done
+                    os.ftruncate(fd_out, 0)
+                os.close(fd_in)
+                os.close(fd_out)
+                source_file, dest_file, _ = pairs[index]
+                if success:
+                    shutil.copystat(source_file, dest_file)
+                    log.info(f"Copied: {source_file} -> {dest_file}")
+                    results[index] = True
+                else:
+                    threaded[index] = executor.submit(copy_file, pairs[index])
+    finally:
+        liburing.io_uring_queue_exit(ring)
+
+    for index, future in threaded.items():
+        results[index] = future.result()
+    return results
+
+
+def copy_many(pairs, max_workers=COPY_THREADS, use_io_uring=False):
+    """
+    Copy a batch of (source_file, dest_file, source_entry) jobs, see copy_file.
+    The copies run in threads so
+    the storage latency of many small files overlaps instead of adding up.
+    With use_io_uring, copy_many_uring is tried first.
+
+    Returns:
+        list: copy_file result for every pair, in order
+    """
+    if not pairs:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if use_io_uring:
+            if liburing is None:
+                log.warning("liburing is not installed, copying with threads")
+            else:
+                results = copy_many_uring(pairs, executor)
+                if results is not None:
+                    return results
+        return list(executor.map(copy_file, pairs))
 
-    print(f"Total gamelist.xml files moved: {files_moved}")
-    print(f"Total gamelist.xml files skipped: {files_skipped}")
 
+def tally_job(counts, manifest, job, success):
+    """
+    Count a finished job and record it in the manifest if it succeeded.
 
-def copy_media_folders(input_dir, output_dir, optimize_videos=True, use_av1=False):
+    Args:
+        counts: MediaCounts to update
+        manifest: Optional manifest connection
+        job: (kind, source_file, dest_file, source_entry) tuple from iter_media_jobs
+        success: Result of the job, None if a plain copy found dest_file already there
+    """
+    kind, source_file, dest_file, source_entry = job
+    if success is None:
+        counts.skipped += 1
+    elif not success:
+        return
+    else:
+        counts.files_copied += 1
+        if kind == "video":
+            counts.videos_optimized += 1
+        elif kind == "image":
+            counts.images_optimized += 1
+    if manifest is not None:
+        manifest_mark_done(manifest, source_file, dest_file, source_entry)
+
+
+def copy_media_folders(
+    input_dir,
+    output_dir,
+    optimize_videos=True,
+    use_av1=False,
+    use_hw_encoder=True,
+    max_image_size=None,
+    use_manifest=True,
+    use_avif=False,
+    max_concurrency=None,
+    video_concurrency=None,
+    image_concurrency=None,
+    use_io_uring=False,
+    inode_order=False,
+    walk_threads=0,
+):
     """
     Recursively scan through input_dir for 'media' folders and copy their contents to
     output_dir/downloaded_media/{parent_folder_name}/ structure.
-    Optimize MP4 videos by converting to MKV with x265 encoding if optimize_videos is True.
-    Optimize PNG and JPG images by converting to WebP format.
+    Optimize MP4 videos by converting to MKV with HEVC encoding if optimize_videos is True.
+    Optimize PNG and JPG images by converting to WebP format, downscaling them to
+    max_image_size pixels per side if it is set. With use_avif, AVIF is used
+    instead of WebP wherever it is smaller.
+
+    Videos and PDFs run in a small CPU pool of video_concurrency processes since
+    every encode is already multi-threaded, images are spread over
+    image_concurrency processes and plain files are copied in threads. Both
+    default to values derived from max_concurrency (one per CPU core by default).
+    Jobs are handed to the pools as the walk finds them, so processing starts
+    before the walk is done.
+    With use_io_uring, plain files are copied through io_uring where possible.
+    With inode_order, input_dir is walked in inode order to save hard disk seeks.
+    With walk_threads, that many threads list directories ahead of the walk.
+    If use_manifest is True, processed files are recorded in a manifest so later
+    runs can skip them without checking the destination.
     """
     # Create the downloaded_media directory in the output folder if it doesn't exist
     downloaded_media_dir = os.path.join(output_dir, "downloaded_media")
-    if not os.path.exists(downloaded_media_dir):
-        os.makedirs(downloaded_media_dir)
+    ensure_dir(downloaded_media_dir)
 
     # Count for reporting
-    media_folders_processed = 0
-    files_copied = 0
-    files_skipped = 0
-    videos_optimized = 0
-    images_optimized = 0
+    counts = MediaCounts()
+
+    manifest = open_manifest(output_dir) if use_manifest else None
+
+    # Detect the hardware encoder once here instead of in every worker
+    hevc_encoder = None
+    if optimize_videos and not use_av1 and use_hw_encoder:
+        hevc_encoder = detect_hevc_encoder()
+
+    max_workers = max_concurrency or os.cpu_count() or 1
+    video_workers = video_concurrency or max(1, max_workers // VIDEO_THREADS)
+    image_workers = image_concurrency or max_workers
+    run_job = functools.partial(
+        run_media_job,
+        use_av1=use_av1,
+        use_hw_encoder=use_hw_encoder,
+        max_image_size=max_image_size,
+        use_avif=use_avif,
+    )
+    run_image_batch = functools.partial(
+        optimize_image_batch, max_dimension=max_image_size, use_avif=use_avif
+    )
 
-    # Walk through the directory tree
-    for root, dirs, _ in os.walk(input_dir):
-        for dir_name in dirs:
-            if dir_name == "media":
-                # Get full path to the media directory
-                media_dir_path = os.path.join(root, dir_name)
-
-                # Get the parent folder name (e.g., "megadrive")
-                parent_folder = os.path.basename(root)
-
-                # Create destination directory for this system
-                dest_system_dir = os.path.join(downloaded_media_dir, parent_folder)
-                if not os.path.exists(dest_system_dir):
-                    os.makedirs(dest_system_dir)
-
-                # For each subfolder in the media directory, process it
-                for item in os.listdir(media_dir_path):
-                    item_path = os.path.join(media_dir_path, item)
-
-                    # Only process directories (we want to copy each folder in media/)
-                    if os.path.isdir(item_path):
-                        dest_item_path = os.path.join(dest_system_dir, item)
-
-                        # Create the base destination directory if it doesn't exist
-                        if not os.path.exists(dest_item_path):
-                            os.makedirs(dest_item_path)
-
-                        # Walk through all files in the directory
-                        for file_root, _, files in os.walk(item_path):
-                            # Get the relative path from item_path
-                            rel_path = os.path.relpath(file_root, item_path)
-                            dest_file_dir = os.path.join(dest_item_path, rel_path)
-
-                            # Create destination directory if it doesn't exist
-                            if rel_path != "." and not os.path.exists(dest_file_dir):
-                                os.makedirs(dest_file_dir)
-
-                            # Process each file
-                            for file in files:
-                                # Skip macOS hidden files at the outset
-                                if file.startswith("._"):
-                                    print(
-                                        f"Skipping macOS hidden file: {file} (completely bypassing all processing)"
-                                    )
-                                    files_skipped += 1
-                                    continue  # This should skip to the next file without further processing
-
-                                # Get full path to source file
-                                src_file_path = os.path.join(file_root, file)
-
-                                # Double-check that we're not processing a hidden file (defensive check)
-                                if os.path.basename(src_file_path).startswith("._"):
-                                    print(
-                                        f"Secondary hidden file check caught: {src_file_path}"
-                                    )
-                                    files_skipped += 1
-                                    continue
-
-                                file_lower = file.lower()
-
-                                # Check if it's a video file to optimize
-                                if optimize_videos and file_lower.endswith(".mp4"):
-                                    # Change extension to .mkv for optimized files
-                                    dest_file_name = os.path.splitext(file)[0] + ".mkv"
-                                    dest_file_path = os.path.join(
-                                        dest_file_dir, dest_file_name
-                                    )
-
-                                    # Check if destination already exists
-                                    if (
-                                        os.path.exists(dest_file_path)
-                                        and os.path.getsize(dest_file_path) > 0
-                                    ):
-                                        print(
-                                            f"Skipping existing video: {dest_file_path}"
-                                        )
-                                        files_skipped += 1
-                                        continue
-
-                                    # Optimize and convert the video
-                                    if optimize_video(
-                                        src_file_path, dest_file_path, use_av1
-                                    ):
-                                        videos_optimized += 1
-                                        files_copied += 1
-                                # Check if it's a PDF file to optimize
-                                elif file_lower.endswith(".pdf"):
-                                    dest_file_path = os.path.join(dest_file_dir, file)
-
-                                    # Check if destination already exists
-                                    if (
-                                        os.path.exists(dest_file_path)
-                                        and os.path.getsize(dest_file_path) > 0
-                                    ):
-                                        print(
-                                            f"Skipping existing PDF: {dest_file_path}"
-                                        )
-                                        files_skipped += 1
-                                        continue
-
-                                    # Optimize PDF file
-                                    if optimize_pdf(src_file_path, dest_file_path):
-                                        files_copied += 1
-                                        print(
-                                            f"PDF processed: {src_file_path} -> {dest_file_path}"
-                                        )
-                                # Check if it's an image file to optimize
-                                elif file_lower.endswith((".png", ".jpg", ".jpeg")):
-                                    dest_file_path = os.path.join(dest_file_dir, file)
-
-                                    # Check if destination already exists
-                                    if (
-                                        os.path.exists(dest_file_path)
-                                        and os.path.getsize(dest_file_path) > 0
-                                    ):
-                                        print(
-                                            f"Skipping existing image: {dest_file_path}"
-                                        )
-                                        files_skipped += 1
-                                        continue
-
-                                    # Optimize and convert the image
-                                    if optimize_image(src_file_path, dest_file_path):
-                                        images_optimized += 1
-                                        files_copied += 1
-                                else:
-                                    # Regular file copy
-                                    dest_file_path = os.path.join(dest_file_dir, file)
-
-                                    # Check if destination already exists
-                                    if (
-                                        os.path.exists(dest_file_path)
-                                        and os.path.getsize(dest_file_path) > 0
-                                    ):
-                                        print(
-                                            f"Skipping existing file: {dest_file_path}"
-                                        )
-                                        files_skipped += 1
-                                        continue
-
-                                    shutil.copy2(src_file_path, dest_file_path)
-                                    files_copied += 1
-                                    print(
-                                        f"Copied: {src_file_path} -> {dest_file_path}"
-                                    )
-
-                media_folders_processed += 1
-
-    print(f"Total media folders processed: {media_folders_processed}")
-    print(f"Total files copied: {files_copied}")
-    print(f"Total files skipped (already exist): {files_skipped}")
+    try:
+        with multiprocessing.Manager() as manager:
+            print_lock = manager.Lock()
+            with ProcessPoolExecutor(
+                max_workers=video_workers,
+                initializer=init_worker,
+                initargs=(
+                    print_lock,
+                    _log_queue,
+                    log.getEffectiveLevel(),
+                    hevc_encoder,
+                ),
+            ) as cpu_executor, ProcessPoolExecutor(
+                max_workers=image_workers,
+                initializer=init_worker,
+                initargs=(print_lock, _log_queue, log.getEffectiveLevel()),
+            ) as image_executor, make_walk_executor(
+                walk_threads
+            ) as walk_executor:
+                # Jobs are handed to the pools while the walk goes on
+                futures = {}
+                image_batch = []
+                images_submitted = 0
+                copy_jobs = []
+
+                def submit_image_batch(batch):
+                    # DirEntry objects can't be sent to other processes, they stay here
+                    pairs = [(source, dest) for _, source, dest, _ in batch]
+                    futures[image_executor.submit(run_image_batch, pairs)] = batch
+
+                def copy_batch(batch):
+                    # Plain copies run in threads here while the pools are busy
+                    copy_results = copy_many(
+                        [(source, dest, entry) for _, source, dest, entry in batch],
+                        use_io_uring=use_io_uring,
+                    )
+                    for job, success in zip(batch, copy_results):
+                        tally_job(counts, manifest, job, success)
+
+                for job in iter_media_jobs(
+                    input_dir,
+                    downloaded_media_dir,
+                    optimize_videos,
+                    counts,
+                    manifest,
+                    inode_order,
+                    walk_executor,
+                ):
+                    kind = job[0]
+                    if kind == "copy":
+                        copy_jobs.append(job)
+                        if len(copy_jobs) >= COPY_BATCH_SIZE:
+                            copy_batch(copy_jobs)
+                            copy_jobs = []
+                    elif kind == "image":
+                        image_batch.append(job)
+                        # Batches grow with the number of images seen, so small libraries
+                        # still spread over every worker and large ones get full batches
+                        batch_size = min(
+                            IMAGE_BATCH_SIZE, 1 + images_submitted // image_workers
+                        )
+                        if len(image_batch) >= batch_size:
+                            submit_image_batch(image_batch)
+                            images_submitted += len(image_batch)
+                            image_batch = []
+                    else:
+                        futures[cpu_executor.submit(run_job, job[:3])] = [job]
+
+                if image_batch:
+                    submit_image_batch(image_batch)
+                if copy_jobs:
+                    copy_batch(copy_jobs)
+
+                # Count the pool results in the order they finish
+                for future in as_completed(futures):
+                    results = future.result()
+                    if isinstance(results, bool):
+                        results = [results]
+                    for job, success in zip(futures[future], results):
+                        tally_job(counts, manifest, job, success)
+    finally:
+        # Keep what was finished even if the run is interrupted
+        if manifest is not None:
+            manifest.commit()
+            manifest.close()
+
+    log.log(NOTICE, f"Total media folders processed: {counts.media_folders}")
+    log.log(NOTICE, f"Total files copied: {counts.files_copied}")
+    log.log(NOTICE, f"Total files skipped (already exist): {counts.skipped}")
     if optimize_videos:
-        print(f"Total videos optimized: {videos_optimized}")
-    print(f"Total images optimized: {images_optimized}")
+        log.log(NOTICE, f"Total videos optimized: {counts.videos_optimized}")
+    log.log(NOTICE, f"Total images optimized: {counts.images_optimized}")
 
 
 if __name__ == "__main__":
@@ -1048,6 +2315,66 @@ if __name__ == "__main__":
         action="store_true",
         help="Use AV1 encoding instead of x265 for video optimization",
     )
+    parser.add_argument(
+        "--no_hw_encoder",
+        action="store_true",
+        help="Always use x265 even if a hardware HEVC encoder is available",
+    )
+    parser.add_argument(
+        "--max_image_size",
+        type=int,
+        default=None,
+        help="Downscale images so their width and height don't exceed this many pixels",
+    )
+    parser.add_argument(
+        "--no_manifest",
+        action="store_true",
+        help="Check destination files instead of the manifest of processed files",
+    )
+    parser.add_argument(
+        "--avif",
+        action="store_true",
+        help="Also encode images to AVIF and use it when it is smaller than WebP",
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=None,
+        help="Number of files processed at once (default: number of CPU cores)",
+    )
+    parser.add_argument(
+        "--video_concurrency",
+        type=int,
+        default=None,
+        help="Number of videos and PDFs processed at once (default: max_concurrency / 8)",
+    )
+    parser.add_argument(
+        "--image_concurrency",
+        type=int,
+        default=None,
+        help="Number of image conversion processes (default: max_concurrency)",
+    )
+    parser.add_argument(
+        "--io_uring",
+        action="store_true",
+        help="Copy small files through io_uring (Linux, needs the liburing package)",
+    )
+    parser.add_argument(
+        "--inode_order",
+        action="store_true",
+        help="Walk directories in inode order to reduce seeking on hard disks",
+    )
+    parser.add_argument(
+        "--walk_threads",
+        type=int,
+        default=0,
+        help="Threads listing directories in parallel while scanning, helps on network filesystems (default: 0)",
+    )
+    parser.add_argument(
+        "--quiet",
+        action="store_true",
+        help="Only show summaries, warnings and errors instead of a line for every file",
+    )
 
     args = parser.parse_args()
 
@@ -1061,10 +2388,51 @@ if __name__ == "__main__":
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    if not args.skip_gamelists:
-        move_gamelists(args.input_dir, args.output_dir)
-
-    if not args.skip_media:
-        copy_media_folders(
-            args.input_dir, args.output_dir, not args.skip_video_optimization, args.av1
+    # Per-file messages are written by a listener thread from here on
+    listener = start_logging(args.quiet)
+    try:
+        gamelist_args = (
+            args.input_dir,
+            args.output_dir,
+            args.inode_order,
+            args.walk_threads,
         )
+        gamelist_process = None
+        if not args.skip_gamelists:
+            if args.skip_media:
+                move_gamelists(*gamelist_args)
+            else:
+                # The gamelists go to their own output folder, so they are moved in a
+                # separate process while the media is processed
+                gamelist_process = multiprocessing.Process(
+                    target=run_logged,
+                    args=(_log_queue, log.level, move_gamelists, *gamelist_args),
+                )
+                gamelist_process.start()
+
+        if not args.skip_media:
+            copy_media_folders(
+                args.input_dir,
+                args.output_dir,
+                not args.skip_video_optimization,
+                args.av1,
+                not args.no_hw_encoder,
+                args.max_image_size,
+                not args.no_manifest,
+                args.avif,
+                args.max_concurrency,
+                args.video_concurrency,
+                args.image_concurrency,
+                args.io_uring,
+                args.inode_order,
+                args.walk_threads,
+            )
+        if gamelist_process is not None:
+            gamelist_process.join()
+            if gamelist_process.exitcode != 0:
+                log.error(
+                    f"Moving gamelists failed with exit code {gamelist_process.exitcode}"
+                )
+                exit(1)
+    finally:
+        listener.stop()